@@ -1,14 +1,33 @@
 import streamlit as st
+from streamlit.errors import StreamlitAPIException
 import json
 import os
 import uuid
 import base64
+import copy
 import zipfile
 import io
+import tempfile
+from collections import deque
 import pandas as pd
 from datetime import datetime, timedelta
 from pathlib import Path
 import hashlib
+import mmap
+from PIL import Image
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import sys
+import argparse
+from contextlib import contextmanager
+from functools import lru_cache
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking
+    fcntl = None
 
 # Page configuration
 st.set_page_config(
@@ -26,6 +45,73 @@ PAYMENT_FILE = DATA_DIR / "payments.json"
 INSTRUCTIONS_FILE = DATA_DIR / "instructions.json"
 UPLOADS_DIR = DATA_DIR / "uploads"
 UPLOADS_DIR.mkdir(exist_ok=True)
+EXPORTS_DIR = DATA_DIR / "exports"
+SPOOL_DIR = DATA_DIR / "spool"
+THUMBNAILS_DIR = DATA_DIR / "thumbnails"
+ARCHIVE_DIR = DATA_DIR / "archive"
+DATABASE_FILE = DATA_DIR / "payments.db"
+JOURNAL_FILE = DATA_DIR / "journal.jsonl"
+JOURNAL_COMPACTING_FILE = DATA_DIR / "journal.compacting.jsonl"
+STORAGE_LOCK_FILE = DATA_DIR / ".storage.lock"
+COMPACT_LOCK_FILE = DATA_DIR / ".compact.lock"
+PHASH_INDEX_FILE = DATA_DIR / "phash_index.jsonl"
+
+# Journal entries are folded back into the JSON snapshots once this many pile up
+JOURNAL_COMPACT_THRESHOLD = 500
+
+# Writes arriving within this many seconds of each other are committed together
+GROUP_COMMIT_WINDOW = 0.01
+
+# Screenshot previews: longest side in pixels, JPEG quality, and cache size limit
+THUMBNAIL_MAX_SIZE = 800
+THUMBNAIL_QUALITY = 70
+THUMBNAIL_CACHE_MAX_MB = 256
+
+# Screenshots whose 64-bit perceptual hashes differ in at most this many bits are near-duplicates
+NEAR_DUPLICATE_DISTANCE = 6
+
+# Archived screenshots are appended to a pack until it reaches this size
+ARCHIVE_PACK_MAX_MB = 256
+
+# Threads re-encoding and otherwise processing screenshots in the background
+SCREENSHOT_WORKERS = 2
+
+# Screenshot files removed at once by bulk deletes
+FILE_DELETE_WORKERS = 8
+
+# Submitted screenshots waiting for a worker; beyond this many, submit does the work itself
+SCREENSHOT_QUEUE_LIMIT = 32
+
+# Payments still processing this long after submission, with no spooled upload, are marked failed
+SCREENSHOT_STALE_SECONDS = 600
+
+# Uploads are copied to disk in pieces of this many bytes
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Accepted screenshot formats, recognised by their leading bytes
+IMAGE_SIGNATURES = {b"\x89PNG\r\n\x1a\n": "png", b"\xff\xd8\xff": "jpg"}
+
+# Unreferenced uploads younger than this may belong to a submission still being saved
+ORPHAN_GRACE_SECONDS = 3600
+
+# Payment statuses, in the order filters list them
+PAYMENT_STATUSES = ["Paid", "Unpaid", "Pending"]
+
+# Datetime fields stored as ISO strings, with the epoch-seconds field kept alongside each
+TIMESTAMP_FIELDS = {
+    "payment_datetime": "payment_ts",
+    "registration_date": "registration_ts",
+    "submission_date": "submission_ts"
+}
+
+# Display format for dates and times
+DATETIME_FORMAT = "%d-%m-%Y %I:%M %p"
+
+# Page sizes offered by paginated lists
+PAGE_SIZES = [10, 25, 50, 100]
+
+# Storage backend for students and payments: "json" (default) or "sqlite"
+STORAGE_BACKEND = os.environ.get("PAYMENT_STORAGE_BACKEND", "json").lower()
 
 # Initialize data files
 def init_files():
@@ -53,7 +139,11 @@ def init_files():
             "screenshot_settings": {
                 "allow_download": True,
                 "allow_delete": True,
-                "max_file_size_mb": 5
+                "max_file_size_mb": 5,
+                "compress_enabled": False,
+                "compress_quality": 75,
+                "compress_max_dimension": 1600,
+                "keep_original": True
             }
         },
         "payments": [],
@@ -95,8 +185,13 @@ def load_data(file_path, default=[]):
         return default
 
 def save_data(file_path, data):
-    with open(file_path, 'w') as f:
+    """Write to a temp file and rename it into place so readers never see a partial file"""
+    tmp_path = file_path.with_name(f".{file_path.name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_path, 'w') as f:
         json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
 
 # Query params handling for different Streamlit versions
 def get_query_params():
@@ -127,30 +222,138 @@ def get_query_params():
     # Return empty dict if both methods fail
     return {}
 
+# Partial reruns for different Streamlit versions
+def fragment(func):
+    """Let func rerun on its own where Streamlit supports fragments"""
+    if hasattr(st, 'fragment'):
+        return st.fragment(func)
+    if hasattr(st, 'experimental_fragment'):
+        return st.experimental_fragment(func)
+    return func
+
+def rerun_fragment():
+    """Rerun only the current fragment, or the whole page on older Streamlit"""
+    try:
+        st.rerun(scope="fragment")
+    except (TypeError, StreamlitAPIException):
+        # No scope argument, or this run wasn't started by the fragment
+        st.rerun()
+
+# Pagination
+def paginate(items, key, default_page_size=25):
+    """Draw page controls and return the items on the current page
+
+    items should already be in a stable order so a page shows the same
+    records from one rerun to the next.
+    """
+    col1, col2, col3 = st.columns([1, 1, 2])
+    with col1:
+        page_size = st.selectbox("Per Page", PAGE_SIZES, index=PAGE_SIZES.index(default_page_size), key=f"{key}_page_size")
+    page_count = max(1, -(-len(items) // page_size))
+    # Filters may have shrunk the list since the page was chosen
+    st.session_state[f"{key}_page"] = min(st.session_state.get(f"{key}_page", 1), page_count)
+    with col2:
+        page = st.number_input("Page", min_value=1, max_value=page_count, step=1, key=f"{key}_page")
+    start = (page - 1) * page_size
+    page_items = items[start:start + page_size]
+    with col3:
+        st.write("")  # Spacer
+        if page_items:
+            st.caption(f"Showing {start + 1}-{start + len(page_items)} of {len(items)} (page {page} of {page_count})")
+    return page_items
+
 # Format date and time display
+@lru_cache(maxsize=4096)
 def format_datetime(dt_string):
     """Format datetime string to readable format"""
     try:
         if not dt_string:
             return "Not specified"
         dt = datetime.fromisoformat(dt_string)
-        return dt.strftime("%d-%m-%Y %I:%M %p")
+        return dt.strftime(DATETIME_FORMAT)
     except:
         return dt_string
 
+def to_timestamp(dt_string):
+    """Epoch seconds of an ISO datetime string, or None if it doesn't parse
+
+    Stored datetimes are naive local time; they are counted from a naive
+    epoch so the timestamp formats back to the same wall-clock time.
+    """
+    try:
+        return int((datetime.fromisoformat(dt_string) - datetime(1970, 1, 1)).total_seconds())
+    except:
+        return None
+
+def stamp_timestamps(fields):
+    """Add the epoch field for every datetime field present in a record or update"""
+    for field, ts_field in TIMESTAMP_FIELDS.items():
+        if field in fields:
+            fields[ts_field] = to_timestamp(fields[field])
+    return fields
+
+@st.cache_resource
+def get_timestamp_labels():
+    """Formatted display strings by epoch timestamp, shared by every session"""
+    return {}
+
+def format_timestamps(timestamps):
+    """Format a column of epoch timestamps in one vectorised pass, memoised"""
+    labels = get_timestamp_labels()
+    missing = list({ts for ts in timestamps if ts is not None and ts not in labels})
+    if missing:
+        formatted = pd.to_datetime(pd.Series(missing, dtype="int64"), unit="s").dt.strftime(DATETIME_FORMAT)
+        labels.update(zip(missing, formatted))
+    return [labels.get(ts, "Not specified") for ts in timestamps]
+
+def format_record_datetimes(records, field):
+    """Display strings for one datetime field across many records"""
+    ts_field = TIMESTAMP_FIELDS[field]
+    labels = format_timestamps([record.get(ts_field) for record in records])
+    # Records whose value never parsed keep the old per-value formatting
+    return [
+        label if record.get(ts_field) is not None else format_datetime(record.get(field, ""))
+        for record, label in zip(records, labels)
+    ]
+
 # Admin authentication
 def authenticate(username, password):
-    admin_data = load_data(ADMIN_FILE, {})
+    admin_data = get_admin_data()
     if admin_data.get("username") == username:
         if admin_data.get("password") == hash_password(password):
             return True
     return False
 
+def admin_file_version():
+    """Identify the current admin.json; saves rename a new file into place"""
+    try:
+        stat = ADMIN_FILE.stat()
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return None
+
+@st.cache_resource
+def get_admin_cache():
+    """Parsed admin.json shared by every session in this process"""
+    return {"version": None, "data": {}, "lock": threading.Lock()}
+
 def get_admin_data():
-    return load_data(ADMIN_FILE, {})
+    # Re-parse only when the file changed, then hand out a private copy
+    # because callers edit the result before passing it to update_admin_data
+    cache = get_admin_cache()
+    version = admin_file_version()
+    with cache["lock"]:
+        if version is None or version != cache["version"]:
+            cache["data"] = load_data(ADMIN_FILE, {})
+            cache["version"] = version
+        return copy.deepcopy(cache["data"])
 
 def update_admin_data(data):
-    save_data(ADMIN_FILE, data)
+    cache = get_admin_cache()
+    with cache["lock"]:
+        save_data(ADMIN_FILE, data)
+        cache["data"] = copy.deepcopy(data)
+        cache["version"] = admin_file_version()
 
 def get_payment_amount():
     admin_data = get_admin_data()
@@ -165,7 +368,11 @@ def get_screenshot_settings():
     return admin_data.get("screenshot_settings", {
         "allow_download": True,
         "allow_delete": True,
-        "max_file_size_mb": 5
+        "max_file_size_mb": 5,
+        "compress_enabled": False,
+        "compress_quality": 75,
+        "compress_max_dimension": 1600,
+        "keep_original": True
     })
 
 def update_screenshot_settings(settings):
@@ -240,141 +447,1811 @@ def update_additional_instructions(instructions):
     update_admin_data(admin_data)
 
 # Student deletion function
-def delete_student_by_id(student_id):
-    """Delete a student and all associated data"""
-    students = get_students()
-    payments = get_payments()
-    
-    # Find student
-    student_to_delete = None
-    for student in students:
-        if student.get("id") == student_id:
-            student_to_delete = student
-            break
-    
-    if not student_to_delete:
-        return False
-    
-    # Delete student's screenshot files
-    student_payments = [p for p in payments if p.get("student_id") == student_id]
-    for payment in student_payments:
-        if payment.get("screenshot"):
-            delete_screenshot_file(payment.get("screenshot"))
-    
-    # Remove student from students list
-    updated_students = [s for s in students if s.get("id") != student_id]
-    save_students(updated_students)
-    
-    # Remove student's payments
-    updated_payments = [p for p in payments if p.get("student_id") != student_id]
-    save_payments(updated_payments)
-    
-    return True
-
 def delete_multiple_students(student_ids):
-    """Delete multiple students and their associated data"""
-    success_count = 0
-    fail_count = 0
+    """Delete multiple students and their associated data
+
+    All records go in one commit; screenshot files are removed afterwards,
+    concurrently, once no record points at them. Returns
+    ({student_id: "deleted" | "not found"}, {filename: error}) with the
+    files that could not be deleted.
+    """
+    results = {}
+    failed_files = {}
+    ops = []
+    payments = []
+    for student_id in dict.fromkeys(student_ids):
+        if get_student_by_id(student_id) is None:
+            results[student_id] = "not found"
+            continue
+        payments.extend(get_student_payments(student_id))
+        ops.append({"op": "delete", "table": "students", "id": student_id})
+        ops.append({"op": "delete", "table": "payments", "where": {"student_id": student_id}})
+        results[student_id] = "deleted"
     
-    for student_id in student_ids:
-        if delete_student_by_id(student_id):
-            success_count += 1
-        else:
-            fail_count += 1
+    if ops:
+        commit_operations(ops)
+        # Files still shared with other students' payments are kept
+        failed_files = delete_screenshot_files(f for payment in payments for f in stored_files(payment))
     
-    return success_count, fail_count
+    return results, failed_files
 
 # Screenshot management
-def delete_screenshot_file(filename):
-    """Delete screenshot file from server"""
+def screenshot_in_use(filename, released_ids=()):
+    """Whether payments other than released_ids still reference a stored screenshot"""
+    payments = get_index().file_payments.get(filename, {})
+    return any(payment_id not in released_ids for payment_id in payments)
+
+def delete_payment_screenshots(payment, released_ids=()):
+    """Delete a payment's screenshot and any original kept alongside it"""
+    if payment.get("original_screenshot"):
+        delete_screenshot_file(payment.get("original_screenshot"), released_ids)
+    return delete_screenshot_file(payment.get("screenshot"), released_ids)
+
+def remove_screenshot_file(filename, released_ids=()):
+    """Delete a stored screenshot unless still referenced; raises if the delete fails"""
+    if not filename:
+        return False
+    if screenshot_in_use(filename, released_ids):
+        return True
+    for file_path in screenshot_candidates(filename):
+        try:
+            file_path.unlink()
+        except FileNotFoundError:
+            continue
+        thumbnail_path(filename).unlink(missing_ok=True)
+        return True
+    if get_screenshot_archive().remove(filename):
+        thumbnail_path(filename).unlink(missing_ok=True)
+        return True
+    return False
+
+def delete_screenshot_file(filename, released_ids=()):
+    """Delete screenshot file from server once no other payment references it"""
     try:
-        if filename:
-            file_path = UPLOADS_DIR / filename
-            if file_path.exists():
-                file_path.unlink()
-                return True
+        return remove_screenshot_file(filename, released_ids)
     except Exception as e:
         st.error(f"Error deleting screenshot: {e}")
     return False
 
+def delete_screenshot_files(filenames, released_ids=()):
+    """Delete several screenshot files concurrently; returns {filename: error} for failures
+
+    Errors are returned rather than shown: pool threads can't write to the page.
+    """
+    filenames = list(dict.fromkeys(f for f in filenames if f))
+    if not filenames:
+        return {}
+    def delete(filename):
+        try:
+            remove_screenshot_file(filename, released_ids)
+        except Exception as e:
+            return str(e)
+        return None
+    with ThreadPoolExecutor(max_workers=FILE_DELETE_WORKERS) as pool:
+        errors = pool.map(delete, filenames)
+        return {filename: error for filename, error in zip(filenames, errors) if error}
+
+def show_file_delete_failures(failed_files):
+    """Report screenshot files a bulk delete couldn't remove"""
+    if failed_files:
+        filename, error = next(iter(failed_files.items()))
+        st.error(f"Could not delete {len(failed_files)} screenshot file(s), e.g. {filename}: {error}")
+
 def remove_screenshot_from_payment(payment_id):
     """Remove screenshot reference from payment record"""
-    payments = get_payments()
+    update_payment_fields(payment_id, {
+        "screenshot": None,
+        "original_screenshot": None,
+        "screenshot_deleted": True,
+        "screenshot_deleted_date": datetime.now().isoformat()
+    })
+
+def delete_screenshots(payments):
+    """Delete the screenshots of many payments in one commit
+
+    Payments and their students are marked screenshot-deleted first, then
+    the files no other payment uses are removed concurrently. Returns how
+    many payments were cleared and {filename: error} for files that could
+    not be deleted.
+    """
+    payments = [p for p in payments if p.get("screenshot") and not p.get("screenshot_deleted")]
+    if not payments:
+        return 0, {}
+    now = datetime.now().isoformat()
+    ops = []
     for payment in payments:
-        if payment.get("id") == payment_id:
-            payment["screenshot"] = None
-            payment["screenshot_deleted"] = True
-            payment["screenshot_deleted_date"] = datetime.now().isoformat()
-            break
-    save_payments(payments)
+        ops.append({"op": "update", "table": "payments", "id": payment["id"], "fields": {
+            "screenshot": None,
+            "original_screenshot": None,
+            "screenshot_deleted": True,
+            "screenshot_deleted_date": now
+        }})
+    for student_id in dict.fromkeys(p.get("student_id") for p in payments):
+        ops.append({"op": "update", "table": "students", "id": student_id, "fields": {"screenshot_deleted": True}})
+    commit_operations(ops)
+    failed_files = delete_screenshot_files(f for payment in payments for f in stored_files(payment))
+    return len(payments), failed_files
 
 def remove_screenshot_from_student(student_id):
     """Remove screenshot reference from student record"""
-    students = get_students()
-    for student in students:
-        if student.get("id") == student_id:
-            student["screenshot_deleted"] = True
-            break
-    save_students(students)
+    update_student_fields(student_id, {"screenshot_deleted": True})
+
+def show_screenshot_download(payment, key, label="📥 Download", **kwargs):
+    """Download button that only reads the screenshot once the user asks for it"""
+    prepared = st.session_state.setdefault("prepared_downloads", set())
+    if key not in prepared:
+        if not st.button("📥 Prepare Download", key=f"prepare_{key}", **kwargs):
+            return
+        prepared.add(key)
+    img_bytes = view_screenshot(payment.get("screenshot"))
+    if img_bytes is None:
+        st.warning("File not found")
+        return
+    st.download_button(label, img_bytes, file_name=payment.get("screenshot"), key=key, **kwargs)
+
+def show_screenshot_preview(payment, key, **kwargs):
+    """View button that opens a thumbnail preview, with the full image on request"""
+    open_previews = st.session_state.setdefault("open_previews", set())
+    if key not in open_previews:
+        if not st.button("👁️ View", key=key, **kwargs):
+            return
+        open_previews.add(key)
+    filename = payment.get("screenshot")
+    if st.checkbox("Full size", key=f"{key}_full"):
+        img_bytes = view_screenshot(filename)
+    else:
+        img_bytes = get_thumbnail(filename) or view_screenshot(filename)
+    if img_bytes:
+        st.image(img_bytes, caption="Payment Screenshot", use_column_width=True)
+    else:
+        st.warning("File not found")
+    if st.button("Close", key=f"{key}_close"):
+        open_previews.discard(key)
+        rerun_fragment()
 
 def view_screenshot(filename):
     """View screenshot in modal"""
     if filename:
-        file_path = UPLOADS_DIR / filename
+        for file_path in screenshot_candidates(filename):
+            try:
+                with open(file_path, "rb") as f:
+                    return f.read()
+            except FileNotFoundError:
+                continue
+        return get_screenshot_archive().read(filename)
+    return None
+
+# Upload directory layout
+def upload_path(filename):
+    """Sharded location of a screenshot: uploads/<ab>/<cd>/<filename>
+
+    The two levels come from the SHA-256 of the filename, so legacy names
+    spread as evenly as content-addressed ones.
+    """
+    key = hashlib.sha256(filename.encode()).hexdigest()
+    return UPLOADS_DIR / key[:2] / key[2:4] / filename
+
+def screenshot_candidates(filename):
+    """Places a screenshot file may be, in the order to try them
+
+    The shard is tried again last because a flat file may be moved into it
+    between the first two attempts.
+    """
+    return (upload_path(filename), UPLOADS_DIR / filename, upload_path(filename))
+
+def find_screenshot(filename):
+    """Path of a stored screenshot, including ones still in the flat layout"""
+    if not filename:
+        return None
+    for file_path in screenshot_candidates(filename):
         if file_path.exists():
-            with open(file_path, "rb") as f:
-                img_bytes = f.read()
-            return img_bytes
+            return file_path
+    return None
+
+def screenshot_exists(filename):
+    """Whether a screenshot is stored, either as a file or in the archive"""
+    return find_screenshot(filename) is not None or get_screenshot_archive().contains(filename)
+
+def migrate_uploads_to_shards():
+    """Move screenshots from the flat layout into their shards
+
+    Each file is moved with an atomic rename and readers look in both
+    places, so this can run while the app is serving requests.
+    """
+    moved = 0
+    for file_path in UPLOADS_DIR.iterdir():
+        if not file_path.is_file() or file_path.name.startswith("."):
+            continue
+        target = upload_path(file_path.name)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.replace(file_path, target)
+            moved += 1
+        except FileNotFoundError:
+            # Deleted or moved by someone else meanwhile
+            continue
+    return moved
+
+# Screenshot archive
+class ScreenshotArchive:
+    """Append-only pack files holding old screenshots
+
+    Screenshots are appended to ARCHIVE_DIR/pack-NNNNN.pack and located
+    through index.jsonl, one line per file with its pack, offset and
+    length. Deleting an archived screenshot appends a tombstone line; pack
+    space is never rewritten. Packs are read through mmap, so a read is a
+    slice of the mapping rather than a seek and read.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.index_file = self.directory / "index.jsonl"
+        self.lock_file = self.directory / ".archive.lock"
+        self.lock = threading.Lock()
+        self.offset = 0
+        self.entries = {}
+        self.maps = {}
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive lock against other processes writing the archive"""
+        self.directory.mkdir(exist_ok=True)
+        with open(self.lock_file, 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _sync(self):
+        try:
+            with open(self.index_file, "rb") as f:
+                f.seek(self.offset)
+                chunk = f.read()
+        except FileNotFoundError:
+            return
+        # Only consume whole lines; a partly written one is read next time
+        end = chunk.rfind(b"\n") + 1
+        for line in chunk[:end].splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get("deleted"):
+                self.entries.pop(entry["name"], None)
+            else:
+                self.entries[entry["name"]] = (entry["pack"], entry["offset"], entry["length"])
+        self.offset += end
+
+    def _append_index(self, entries):
+        with open(self.index_file, "a") as f:
+            f.write("".join(json.dumps(entry) + "\n" for entry in entries))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def contains(self, name):
+        with self.lock:
+            self._sync()
+            return name in self.entries
+
+    def names(self):
+        with self.lock:
+            self._sync()
+            return set(self.entries)
+
+    def read(self, name):
+        with self.lock:
+            self._sync()
+            entry = self.entries.get(name)
+            if entry is None:
+                return None
+            pack, offset, length = entry
+            mapped = self.maps.get(pack)
+            if mapped is None or len(mapped) < offset + length:
+                # The pack grew since it was mapped
+                if mapped is not None:
+                    mapped.close()
+                with open(self.directory / pack, "rb") as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.maps[pack] = mapped
+            return mapped[offset:offset + length]
+
+    def add(self, files):
+        """Pack (name, path) pairs and remove the loose files; returns (count, bytes)"""
+        max_bytes = ARCHIVE_PACK_MAX_MB * 1024 * 1024
+        count = 0
+        total = 0
+        with self.lock, self._locked():
+            self._sync()
+            packs = sorted(self.directory.glob("pack-*.pack"))
+            pack_path = packs[-1] if packs else self.directory / "pack-00001.pack"
+            entries = []
+            packed = []
+            f = open(pack_path, "ab")
+            try:
+                for name, file_path in files:
+                    try:
+                        data = file_path.read_bytes()
+                    except FileNotFoundError:
+                        continue
+                    if f.tell() > 0 and f.tell() + len(data) > max_bytes:
+                        f.flush()
+                        os.fsync(f.fileno())
+                        f.close()
+                        pack_path = self.directory / f"pack-{int(pack_path.stem.split('-')[1]) + 1:05d}.pack"
+                        f = open(pack_path, "ab")
+                    entries.append({"name": name, "pack": pack_path.name, "offset": f.tell(), "length": len(data)})
+                    f.write(data)
+                    packed.append(file_path)
+                    total += len(data)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+            if entries:
+                # Index only after the data is durable, and unlink only after the index is
+                self._append_index(entries)
+                self._sync()
+            for file_path in packed:
+                file_path.unlink(missing_ok=True)
+                count += 1
+        return count, total
+
+    def remove(self, name):
+        with self.lock, self._locked():
+            self._sync()
+            if name not in self.entries:
+                return False
+            self._append_index([{"name": name, "deleted": True}])
+            self._sync()
+            return True
+
+@st.cache_resource
+def get_screenshot_archive():
+    return ScreenshotArchive(ARCHIVE_DIR)
+
+def archive_old_screenshots(older_than_days):
+    """Move screenshots of payments submitted before the cutoff into the archive"""
+    cutoff = (datetime.now() - timedelta(days=older_than_days)).isoformat()
+    files = []
+    for payment in get_payments():
+        filename = payment.get("screenshot")
+        if not filename or payment.get("screenshot_deleted"):
+            continue
+        if (payment.get("submission_date") or payment.get("payment_datetime") or cutoff) >= cutoff:
+            continue
+        file_path = find_screenshot(filename)
+        if file_path is not None:
+            files.append((filename, file_path))
+    # Content-addressed files can be shared by several payments
+    files = list(dict(files).items())
+    return get_screenshot_archive().add(files)
+
+# Screenshot garbage collection
+def collect_screenshot_garbage(delete_orphans=False, repair_dangling=False):
+    """Compare stored files with payment references in a single pass
+
+    Orphans are files no payment points at (including temp files left by
+    interrupted uploads); dangling payments point at files that no longer
+    exist. Returns a report and optionally deletes the former and marks
+    the latter as having no screenshot.
+    """
+    referenced = {}
+    for payment in get_payments():
+        for filename in stored_files(payment):
+            referenced.setdefault(filename, []).append(payment)
+    
+    cutoff = time.time() - ORPHAN_GRACE_SECONDS
+    stored = set()
+    orphans = []
+    for root, _, files in os.walk(UPLOADS_DIR):
+        for name in files:
+            file_path = Path(root) / name
+            try:
+                stat = file_path.stat()
+            except FileNotFoundError:
+                continue
+            if not name.startswith("."):
+                stored.add(name)
+                if name in referenced:
+                    continue
+            if stat.st_mtime < cutoff:
+                orphans.append((file_path, stat.st_size))
+    
+    stored |= get_screenshot_archive().names()
+    dangling = [payment for name in referenced.keys() - stored for payment in referenced[name]]
+    report = {
+        "stored_files": len(stored),
+        "orphans": [str(file_path) for file_path, _ in orphans],
+        "reclaimable_bytes": sum(size for _, size in orphans),
+        "dangling": [payment.get("id") for payment in dangling],
+        "deleted": 0,
+        "repaired": 0,
+    }
+    
+    if delete_orphans:
+        for file_path, _ in orphans:
+            try:
+                file_path.unlink()
+            except FileNotFoundError:
+                continue
+            thumbnail_path(file_path.name).unlink(missing_ok=True)
+            report["deleted"] += 1
+    
+    if repair_dangling and dangling:
+        now = datetime.now().isoformat()
+        ops = []
+        for payment in dangling:
+            ops.append({"op": "update", "table": "payments", "id": payment["id"], "fields": {
+                "screenshot": None,
+                "original_screenshot": None,
+                "screenshot_deleted": True,
+                "screenshot_deleted_date": now,
+                "screenshot_missing": True
+            }})
+            ops.append({"op": "update", "table": "students", "id": payment.get("student_id"), "fields": {"screenshot_deleted": True}})
+        commit_operations(ops)
+        report["repaired"] = len(dangling)
+    
+    return report
+
+def run_cli(argv):
+    """Maintenance commands, e.g. python PaymentCollectionForm.py gc --delete"""
+    parser = argparse.ArgumentParser(prog="PaymentCollectionForm.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+    gc_parser = commands.add_parser("gc", help="Find orphaned screenshot files and dangling references")
+    gc_parser.add_argument("--delete", action="store_true", help="Delete orphaned files")
+    gc_parser.add_argument("--repair", action="store_true", help="Clear references to missing files")
+    archive_parser = commands.add_parser("archive", help="Pack old screenshots into archive files")
+    archive_parser.add_argument("--days", type=int, default=180, help="Archive screenshots older than this many days")
+    args = parser.parse_args(argv)
+    
+    init_files()
+    if args.command == "archive":
+        count, total = archive_old_screenshots(args.days)
+        print(f"Archived {count} file(s) ({total / (1024 * 1024):.2f} MB)")
+        return
+    
+    report = collect_screenshot_garbage(delete_orphans=args.delete, repair_dangling=args.repair)
+    print(f"Stored files: {report['stored_files']}")
+    print(f"Orphaned files: {len(report['orphans'])} ({report['reclaimable_bytes'] / (1024 * 1024):.2f} MB reclaimable)")
+    for file_path in report["orphans"]:
+        print(f"  {file_path}")
+    print(f"Payments with missing files: {len(report['dangling'])}")
+    if args.delete:
+        print(f"Deleted {report['deleted']} orphaned file(s)")
+    if args.repair:
+        print(f"Repaired {report['repaired']} payment(s)")
+
+# Storage backends
+# Record fields copied into their own SQLite columns so they can be indexed
+INDEXED_COLUMNS = {
+    "students": ["roll_number", "payment_status", "payment_datetime"],
+    "payments": ["student_id", "status", "payment_datetime"]
+}
+
+class DuplicateRecordError(ValueError):
+    """Raised when an insert would repeat a value that must stay unique"""
+
+def record_matches(record, op):
+    """Check whether a record is targeted by an update/delete operation"""
+    if "id" in op:
+        return record.get("id") == op["id"]
+    return all(record.get(field) == value for field, value in op["where"].items())
+
+def apply_operation(tables, op):
+    """Apply one insert/update/delete operation to in-memory record lists
+
+    Operations are dicts such as
+    {"op": "insert", "table": "students", "record": {...}, "unique": ["roll_number"]},
+    {"op": "update", "table": "payments", "id": "...", "fields": {...}} or
+    {"op": "delete", "table": "payments", "where": {"student_id": "..."}}.
+    Updates and deletes target a single record by "id" or every record
+    matching "where"; "replace" swaps in a whole new list of records.
+    Inserts overwrite a record with the same id, so replaying a journal
+    over a snapshot that already contains it gives the same result.
+    """
+    table = op["table"]
+    records = tables[table]
+    if op["op"] == "insert":
+        record_id = op["record"].get("id")
+        for i, record in enumerate(records):
+            if record.get("id") == record_id:
+                records[i] = op["record"]
+                break
+        else:
+            records.append(op["record"])
+    elif op["op"] == "update":
+        for record in records:
+            if record_matches(record, op):
+                record.update(op["fields"])
+                if "id" in op:
+                    break
+    elif op["op"] == "delete":
+        tables[table] = [r for r in records if not record_matches(r, op)]
+    elif op["op"] == "replace":
+        tables[table] = list(op["records"])
+    else:
+        raise ValueError(f"Unknown storage operation: {op['op']}")
+
+def check_unique(units, exists):
+    """Return one error (or None) per unit of operations
+
+    A unit fails if one of its inserts repeats a "unique" field value that
+    already exists in storage or in an earlier unit of the same batch.
+    exists(table, field, value) looks the value up in storage.
+    """
+    errors = []
+    claimed = set()
+    for ops in units:
+        error = None
+        keys = []
+        for op in ops:
+            for field in op.get("unique", []):
+                key = (op["table"], field, op["record"].get(field))
+                if key in claimed or key in keys or exists(*key):
+                    error = DuplicateRecordError(f"{field.replace('_', ' ').capitalize()} already exists")
+                keys.append(key)
+        if error is None:
+            claimed.update(keys)
+        errors.append(error)
+    return errors
+
+def notify_listeners(listeners, version_before, version_after, units, errors):
+    """Tell listeners which units of operations were just committed"""
+    applied = [ops for ops, error in zip(units, errors) if error is None]
+    for listener in listeners:
+        try:
+            listener(version_before, version_after, applied)
+        except Exception:
+            pass
+
+def read_journal(file_path):
+    """Read journal entries, skipping a torn last line left by a crash"""
+    entries = []
+    if file_path.exists():
+        with open(file_path, 'r') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    pass
+    return entries
+
+class JsonStorage:
+    """Students and payments kept as JSON snapshots plus an append-only journal
+
+    Each commit appends to journal.jsonl instead of rewriting
+    students.json / payments.json, so a submission costs the same however
+    many records exist. Loads replay the journal over the snapshots, and once
+    it grows past JOURNAL_COMPACT_THRESHOLD entries a background thread
+    folds it back into them. Journal writes hold an exclusive fcntl lock on
+    STORAGE_LOCK_FILE, so sessions in other processes see a consistent view.
+    """
+
+    files = {"students": STUDENTS_FILE, "payments": PAYMENT_FILE}
+
+    def __init__(self):
+        # Fallback when fcntl is unavailable: only serialises this process
+        self._thread_lock = threading.RLock()
+        self._compact_lock = threading.Lock()
+        self._journal_entries = len(read_journal(JOURNAL_FILE))
+        # (table, field) -> ({id: value}, {value: count}) for uniqueness checks,
+        # valid while the storage version equals self._unique_version
+        self._unique = {}
+        self._unique_version = None
+        # Called as listener(version_before, version_after, units) after each commit
+        self.listeners = []
+
+    def version(self):
+        """Changes whenever a snapshot or journal file is written"""
+        stats = []
+        for file_path in (STUDENTS_FILE, PAYMENT_FILE, JOURNAL_COMPACTING_FILE, JOURNAL_FILE):
+            try:
+                stat = file_path.stat()
+                stats.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                stats.append(None)
+        return tuple(stats)
+
+    @contextmanager
+    def _locked(self, lock_file, shared=False, blocking=True):
+        """Hold an advisory lock on lock_file; yields False if not acquired"""
+        if fcntl is None:
+            acquired = self._thread_lock.acquire(blocking)
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    self._thread_lock.release()
+            return
+        with open(lock_file, 'a') as f:
+            mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+            try:
+                fcntl.flock(f, mode if blocking else mode | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _replay(self, tables, entries):
+        for entry in entries:
+            for op in entry["ops"]:
+                if op["table"] in tables:
+                    apply_operation(tables, op)
+
+    def _read_tables(self, tables):
+        # Read the journal before the snapshots: a snapshot that already
+        # includes some of these entries just replays them again harmlessly
+        entries = read_journal(JOURNAL_COMPACTING_FILE) + read_journal(JOURNAL_FILE)
+        data = {table: load_data(self.files[table], []) for table in tables}
+        self._replay(data, entries)
+        return data
+
+    def load(self, table):
+        with self._locked(STORAGE_LOCK_FILE, shared=True):
+            return self._read_tables([table])[table]
+
+    def apply(self, ops):
+        """Commit a single unit of operations, raising if it is rejected"""
+        error = self.commit_batch([ops])[0]
+        if error:
+            raise error
+
+    def _unique_values(self, table, field):
+        """Value counts of one field, read from disk only when not cached"""
+        key = (table, field)
+        if key not in self._unique:
+            by_id = {r.get("id"): r.get(field) for r in self._read_tables([table])[table]}
+            counts = {}
+            for value in by_id.values():
+                counts[value] = counts.get(value, 0) + 1
+            self._unique[key] = (by_id, counts)
+        return self._unique[key][1]
+
+    def _track_unique(self, units):
+        """Patch the cached unique values with committed operations"""
+        for ops in units:
+            for op in ops:
+                for key in list(self._unique):
+                    table, field = key
+                    if op["table"] != table:
+                        continue
+                    by_id, counts = self._unique[key]
+                    if op["op"] == "insert":
+                        record_ids = [op["record"].get("id")]
+                        value = op["record"].get(field)
+                    elif op["op"] == "update" and field in op["fields"] and "id" in op:
+                        record_ids = [op["id"]] if op["id"] in by_id else []
+                        value = op["fields"][field]
+                    elif op["op"] == "delete" and "id" in op:
+                        record_ids = [op["id"]]
+                        value = None
+                    elif op["op"] == "update" and field not in op["fields"]:
+                        continue
+                    else:
+                        # Updates and deletes by "where" and replaces: reload on next use
+                        del self._unique[key]
+                        continue
+                    for record_id in record_ids:
+                        if record_id in by_id:
+                            old = by_id.pop(record_id)
+                            counts[old] -= 1
+                            if not counts[old]:
+                                del counts[old]
+                        if op["op"] != "delete":
+                            by_id[record_id] = value
+                            counts[value] = counts.get(value, 0) + 1
+
+    def commit_batch(self, units):
+        """Validate and append several units of operations with one fsync
+
+        Returns one error (or None) per unit; rejected units are not written.
+        """
+        with self._locked(STORAGE_LOCK_FILE):
+            version_before = self.version()
+            if self._unique_version != version_before:
+                # Written by another process or compacted since the last check
+                self._unique = {}
+            def exists(table, field, value):
+                return self._unique_values(table, field).get(value, 0) > 0
+            errors = check_unique(units, exists)
+            now = datetime.now().isoformat()
+            lines = [json.dumps({"date": now, "ops": ops}) + "\n" for ops, error in zip(units, errors) if error is None]
+            if lines:
+                with open(JOURNAL_FILE, 'ab+') as f:
+                    # Terminate a torn last line so the new entries start on their own line
+                    if f.tell() > 0:
+                        f.seek(-1, os.SEEK_END)
+                        if f.read(1) != b"\n":
+                            lines.insert(0, "\n")
+                    f.write("".join(lines).encode())
+                    f.flush()
+                    os.fsync(f.fileno())
+            self._journal_entries += errors.count(None)
+            should_compact = self._journal_entries >= JOURNAL_COMPACT_THRESHOLD
+            version_after = self.version()
+            self._track_unique([ops for ops, error in zip(units, errors) if error is None])
+            self._unique_version = version_after
+        # Outside the storage lock: listeners take their own locks, and a
+        # reload holding one of those waits on the storage lock
+        notify_listeners(self.listeners, version_before, version_after, units, errors)
+        if should_compact:
+            self.compact_in_background()
+        return errors
+
+    def _fold_compacting_file(self):
+        entries = read_journal(JOURNAL_COMPACTING_FILE)
+        if entries:
+            tables = {table: load_data(file_path, []) for table, file_path in self.files.items()}
+            self._replay(tables, entries)
+            for table, file_path in self.files.items():
+                save_data(file_path, tables[table])
+        with self._locked(STORAGE_LOCK_FILE):
+            if JOURNAL_COMPACTING_FILE.exists():
+                JOURNAL_COMPACTING_FILE.unlink()
+
+    def compact(self, blocking=True):
+        """Fold the journal into the JSON snapshots"""
+        if not self._compact_lock.acquire(blocking):
+            return
+        try:
+            # Only one process compacts at a time
+            with self._locked(COMPACT_LOCK_FILE, blocking=blocking) as acquired:
+                if not acquired:
+                    return
+                # Finish a compaction that was interrupted by a crash first
+                self._fold_compacting_file()
+                with self._locked(STORAGE_LOCK_FILE):
+                    if not JOURNAL_FILE.exists() or JOURNAL_FILE.stat().st_size == 0:
+                        return
+                    # New entries go to a fresh journal while the old one is folded in
+                    os.replace(JOURNAL_FILE, JOURNAL_COMPACTING_FILE)
+                    self._journal_entries = 0
+                self._fold_compacting_file()
+        finally:
+            self._compact_lock.release()
+
+    def compact_in_background(self):
+        if not self._compact_lock.locked():
+            threading.Thread(target=self.compact, kwargs={"blocking": False}, daemon=True).start()
+
+class SqliteStorage:
+    """Students and payments kept in an embedded SQLite database (WAL mode)
+
+    Each record is stored whole as JSON next to a few indexed columns, so
+    uniqueness checks and updates or deletes by id, roll number, student
+    id, status or payment date no longer touch the rest of the data. SQLite's
+    own locking serialises writers across sessions and processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        # Called as listener(version_before, version_after, units) after each commit
+        self.listeners = []
+        self._create_schema()
+
+    def _connect(self):
+        # One connection per thread; Streamlit runs each session on its own thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _create_schema(self):
+        conn = self._connect()
+        with conn:
+            for table, columns in INDEXED_COLUMNS.items():
+                column_sql = ", ".join(f"{c} TEXT" for c in columns)
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (id TEXT PRIMARY KEY, {column_sql}, data TEXT NOT NULL)")
+                for column in columns:
+                    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{column} ON {table} ({column})")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def _row(self, table, record):
+        columns = [record.get(c) for c in INDEXED_COLUMNS[table]]
+        return [record.get("id"), *columns, json.dumps(record)]
+
+    def _insert(self, conn, table, records):
+        placeholders = ", ".join("?" * (len(INDEXED_COLUMNS[table]) + 2))
+        conn.executemany(
+            f"INSERT OR REPLACE INTO {table} VALUES ({placeholders})",
+            [self._row(table, r) for r in records]
+        )
+
+    def _where(self, table, op):
+        if "id" in op:
+            return "id = ?", [op["id"]]
+        for field in op["where"]:
+            if field not in INDEXED_COLUMNS[table]:
+                raise ValueError(f"Cannot filter {table} by unindexed field: {field}")
+        clause = " AND ".join(f"{field} = ?" for field in op["where"])
+        return clause, list(op["where"].values())
+
+    def _apply_ops(self, conn, ops):
+        for op in ops:
+            table = op["table"]
+            if op["op"] == "insert":
+                self._insert(conn, table, [op["record"]])
+            elif op["op"] == "update":
+                clause, params = self._where(table, op)
+                rows = conn.execute(f"SELECT data FROM {table} WHERE {clause}", params).fetchall()
+                updated = []
+                for (data,) in rows:
+                    record = json.loads(data)
+                    record.update(op["fields"])
+                    updated.append(self._row(table, record))
+                set_sql = ", ".join(f"{c} = ?" for c in INDEXED_COLUMNS[table])
+                conn.executemany(
+                    f"UPDATE {table} SET {set_sql}, data = ? WHERE id = ?",
+                    [row[1:] + [row[0]] for row in updated]
+                )
+            elif op["op"] == "delete":
+                clause, params = self._where(table, op)
+                conn.execute(f"DELETE FROM {table} WHERE {clause}", params)
+            elif op["op"] == "replace":
+                conn.execute(f"DELETE FROM {table}")
+                self._insert(conn, table, op["records"])
+            else:
+                raise ValueError(f"Unknown storage operation: {op['op']}")
+
+    def load(self, table):
+        rows = self._connect().execute(f"SELECT data FROM {table} ORDER BY rowid")
+        return [json.loads(data) for (data,) in rows]
+
+    def save(self, table, records):
+        self.apply([{"op": "replace", "table": table, "records": records}])
+
+    def count(self, table):
+        return self._connect().execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    def version(self):
+        """Counter bumped by every committed batch"""
+        return int(self.get_meta("version") or 0)
+
+    def apply(self, ops):
+        """Commit a single unit of operations, raising if it is rejected"""
+        error = self.commit_batch([ops])[0]
+        if error:
+            raise error
+
+    def commit_batch(self, units):
+        """Validate and apply several units of operations in one transaction
+
+        Returns one error (or None) per unit; rejected units are not applied.
+        """
+        conn = self._connect()
+        # Take the write lock up front so the uniqueness checks stay valid
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            def exists(table, field, value):
+                return conn.execute(f"SELECT 1 FROM {table} WHERE {field} = ? LIMIT 1", (value,)).fetchone() is not None
+            errors = check_unique(units, exists)
+            for ops, error in zip(units, errors):
+                if error is None:
+                    self._apply_ops(conn, ops)
+            version_before = self.version()
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (str(version_before + 1),))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        notify_listeners(self.listeners, version_before, version_before + 1, units, errors)
+        return errors
+
+    def get_meta(self, key):
+        row = self._connect().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+class GroupCommitter:
+    """Coalesces writes from concurrent sessions into one storage commit
+
+    The first writer to arrive waits GROUP_COMMIT_WINDOW seconds for others
+    to join, then commits everything queued as a single batch (one journal
+    fsync or one SQLite transaction) and keeps going while more writes
+    queue up behind it. Each caller still gets its own error back.
+    """
+
+    def __init__(self, storage, window):
+        self.storage = storage
+        self.window = window
+        self._lock = threading.Lock()
+        self._pending = []
+        self._leader_active = False
+
+    def submit(self, ops):
+        unit = {"ops": ops, "done": threading.Event(), "error": None}
+        with self._lock:
+            self._pending.append(unit)
+            lead = not self._leader_active
+            self._leader_active = True
+        if lead:
+            time.sleep(self.window)
+            while True:
+                with self._lock:
+                    batch, self._pending = self._pending, []
+                    if not batch:
+                        self._leader_active = False
+                        break
+                self._commit(batch)
+        unit["done"].wait()
+        if unit["error"]:
+            raise unit["error"]
+
+    def _commit(self, batch):
+        try:
+            errors = self.storage.commit_batch([unit["ops"] for unit in batch])
+        except Exception as e:
+            errors = [e] * len(batch)
+        for unit, error in zip(batch, errors):
+            unit["error"] = error
+            unit["done"].set()
+
+def screenshot_key(payment):
+    """Content hash of a payment's screenshot while the payment still holds it"""
+    if payment.get("screenshot") and not payment.get("screenshot_deleted"):
+        return payment.get("screenshot_hash")
     return None
 
+def stored_files(payment):
+    """Files a payment keeps in the screenshot store, including a kept original"""
+    if payment.get("screenshot_deleted"):
+        return ()
+    return tuple(f for f in (payment.get("screenshot"), payment.get("original_screenshot")) if f)
+
+class RecordIndex:
+    """In-memory copy of students and payments with hash indexes
+
+    Holds records keyed by id plus roll number -> student id,
+    student id -> payments, screenshot hash -> payments and stored file
+    -> payments, so lookups are O(1). It is rebuilt from storage
+    whenever the storage version moves on without it, and patched in place
+    for commits made through this process. Records are shared between
+    sessions: change them through commit_operations, never in place.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # Serialises full reloads; never held by commit listeners
+        self._reload_lock = threading.Lock()
+        self.version = None
+        self.tables = {"students": {}, "payments": {}}
+        self.roll_to_student = {}
+        self.student_payments = {}
+        self.screenshot_payments = {}
+        self.file_payments = {}
+
+    def refresh(self, storage):
+        version = storage.version()
+        if version == self.version:
+            return
+        with self._reload_lock:
+            if version == self.version:
+                return
+            # Load into a separate index without holding self.lock, so storage
+            # locks are never taken while it is held
+            fresh = RecordIndex()
+            for table in fresh.tables:
+                for record in storage.load(table):
+                    fresh._add(table, record)
+            with self.lock:
+                if version == self.version:
+                    return
+                self.tables = fresh.tables
+                self.roll_to_student = fresh.roll_to_student
+                self.student_payments = fresh.student_payments
+                self.screenshot_payments = fresh.screenshot_payments
+                self.file_payments = fresh.file_payments
+                self.version = version
+
+    def _add(self, table, record):
+        # Assigning to an existing id keeps the record's original position
+        record_id = record.get("id")
+        old = self.tables[table].get(record_id)
+        self.tables[table][record_id] = record
+        self._reindex(table, old, record)
+
+    def _groups(self, table):
+        """Multi-value indexes of a table as (index, keys function) pairs"""
+        if table == "students":
+            return []
+        return [
+            (self.student_payments, lambda payment: (payment.get("student_id"),)),
+            (self.screenshot_payments, lambda payment: (screenshot_key(payment),)),
+            (self.file_payments, stored_files),
+        ]
+
+    def _reindex(self, table, old, new):
+        """Move a record between index keys; either side may be None"""
+        record_id = (new if new is not None else old).get("id")
+        if table == "students":
+            old_roll = old.get("roll_number") if old is not None else None
+            new_roll = new.get("roll_number") if new is not None else None
+            if old_roll != new_roll and self.roll_to_student.get(old_roll) == record_id:
+                del self.roll_to_student[old_roll]
+            if new_roll is not None:
+                self.roll_to_student.setdefault(new_roll, record_id)
+            return
+        for index, keys in self._groups(table):
+            old_keys = {key for key in keys(old) if key is not None} if old is not None else set()
+            new_keys = {key for key in keys(new) if key is not None} if new is not None else set()
+            for key in old_keys - new_keys:
+                records = index.get(key, {})
+                records.pop(record_id, None)
+                if not records:
+                    index.pop(key, None)
+            for key in new_keys:
+                index.setdefault(key, {})[record_id] = new
+
+    def _remove(self, table, record_id):
+        record = self.tables[table].pop(record_id, None)
+        if record is not None:
+            self._reindex(table, record, None)
+
+    def _targets(self, op):
+        if "id" in op:
+            record = self.tables[op["table"]].get(op["id"])
+            return [record] if record else []
+        where = op["where"]
+        if op["table"] == "payments" and "student_id" in where:
+            candidates = self.student_payments.get(where["student_id"], {}).values()
+        else:
+            candidates = self.tables[op["table"]].values()
+        return [r for r in candidates if record_matches(r, op)]
+
+    def _apply(self, op):
+        table = op["table"]
+        if op["op"] == "insert":
+            self._add(table, op["record"])
+        elif op["op"] == "update":
+            for record in self._targets(op):
+                # Re-add a fresh dict so readers holding the old one are unaffected
+                self._add(table, {**record, **op["fields"]})
+        elif op["op"] == "delete":
+            for record in self._targets(op):
+                self._remove(table, record.get("id"))
+        elif op["op"] == "replace":
+            for record_id in list(self.tables[table]):
+                self._remove(table, record_id)
+            for record in op["records"]:
+                self._add(table, record)
+
+    def on_commit(self, version_before, version_after, units):
+        with self.lock:
+            if self.version != version_before:
+                # Missed someone else's write; the next refresh reloads everything
+                return
+            for ops in units:
+                for op in ops:
+                    self._apply(op)
+            self.version = version_after
+
+def migrate_json_to_sqlite(storage):
+    """One-shot import of the JSON backend's data into SQLite"""
+    if storage.get_meta("migrated_from_json"):
+        return False
+    # Load through JsonStorage so journal entries not yet compacted are included
+    json_storage = JsonStorage()
+    for table in JsonStorage.files:
+        records = json_storage.load(table)
+        if records and storage.count(table) == 0:
+            storage.save(table, records)
+    storage.set_meta("migrated_from_json", datetime.now().isoformat())
+    return True
+
+@st.cache_resource
+def get_storage():
+    """Storage backend shared by every session in this process"""
+    if STORAGE_BACKEND == "sqlite":
+        storage = SqliteStorage(DATABASE_FILE)
+        migrate_json_to_sqlite(storage)
+        return storage
+    return JsonStorage()
+
+@st.cache_resource
+def get_committer():
+    return GroupCommitter(get_storage(), GROUP_COMMIT_WINDOW)
+
+@st.cache_resource
+def get_record_index():
+    index = RecordIndex()
+    get_storage().listeners.append(index.on_commit)
+    return index
+
+def get_index():
+    """Up-to-date record index for the current data version"""
+    index = get_record_index()
+    index.refresh(get_storage())
+    return index
+
+def get_data_version():
+    return get_index().version
+
+def commit_operations(ops):
+    """Write a unit of storage operations through the shared group committer"""
+    for op in ops:
+        if op["op"] == "insert":
+            stamp_timestamps(op["record"])
+        elif op["op"] == "update":
+            stamp_timestamps(op["fields"])
+        elif op["op"] == "replace":
+            for record in op["records"]:
+                stamp_timestamps(record)
+    get_committer().submit(ops)
+
+def backfill_timestamps():
+    """Add epoch fields to records written before they existed, in one commit"""
+    ops = []
+    index = get_index()
+    for table, records in index.tables.items():
+        for record in records.values():
+            fields = {
+                field: record[field] for field, ts_field in TIMESTAMP_FIELDS.items()
+                if record.get(field) and ts_field not in record
+            }
+            if fields:
+                ops.append({"op": "update", "table": table, "id": record["id"], "fields": stamp_timestamps(fields)})
+    if ops:
+        commit_operations(ops)
+    return len(ops)
+
+@st.cache_resource
+def run_timestamp_backfill():
+    """Backfill once per process"""
+    return backfill_timestamps()
+
 # Student management
 def get_students():
-    return load_data(STUDENTS_FILE, [])
-
-def save_students(students):
-    save_data(STUDENTS_FILE, students)
+    return list(get_index().tables["students"].values())
 
 def get_payments():
-    return load_data(PAYMENT_FILE, [])
+    return list(get_index().tables["payments"].values())
+
+def update_student_fields(student_id, fields):
+    commit_operations([{"op": "update", "table": "students", "id": student_id, "fields": fields}])
 
-def save_payments(payments):
-    save_data(PAYMENT_FILE, payments)
+def update_payment_fields(payment_id, fields):
+    commit_operations([{"op": "update", "table": "payments", "id": payment_id, "fields": fields}])
 
 def get_student_by_id(student_id):
-    students = get_students()
-    for student in students:
-        if student.get("id") == student_id:
-            return student
-    return None
+    return get_index().tables["students"].get(student_id)
 
 def get_student_by_roll(roll_number):
-    students = get_students()
-    for student in students:
-        if student.get("roll_number") == roll_number:
-            return student
-    return None
+    index = get_index()
+    return index.tables["students"].get(index.roll_to_student.get(roll_number))
 
 def get_student_payments(student_id):
-    payments = get_payments()
-    return [p for p in payments if p.get("student_id") == student_id]
+    return list(get_index().student_payments.get(student_id, {}).values())
 
-def save_uploaded_file(uploaded_file, student_id):
-    screenshot_settings = get_screenshot_settings()
-    max_size_mb = screenshot_settings.get("max_file_size_mb", 5)
+def get_payments_by_screenshot_hash(content_hash):
+    return list(get_index().screenshot_payments.get(content_hash, {}).values())
+
+def get_screenshot_duplicates(payment):
+    """Other payments that submitted the same screenshot as this one"""
+    return [
+        other for other in get_payments_by_screenshot_hash(screenshot_key(payment))
+        if other.get("id") != payment.get("id")
+    ]
+
+# Record filters
+@st.cache_resource
+def get_frame_cache():
+    """Typed DataFrames of the tables, shared by every session for one data version"""
+    return {"version": None, "frames": {}, "lock": threading.Lock()}
+
+def build_record_frame(table):
+    """One row per record with the columns the filters look at, already parsed"""
+    records = list(get_index().tables[table].values())
+    status_field = "payment_status" if table == "students" else "status"
+    return pd.DataFrame({
+        "id": [r.get("id") for r in records],
+        "status": pd.Categorical([r.get(status_field) for r in records], categories=PAYMENT_STATUSES),
+        "name": pd.Series([r.get("name") or "" for r in records], dtype=object).str.lower(),
+        "roll_number": pd.Series([r.get("roll_number") or "" for r in records], dtype=object),
+        "added_by_admin": pd.Series([r.get("added_by_admin") == True for r in records], dtype=bool),
+        "has_screenshot": pd.Series([bool(r.get("screenshot")) and not r.get("screenshot_deleted") for r in records], dtype=bool),
+        "payment_datetime": pd.to_datetime(pd.Series([r.get("payment_ts") for r in records], dtype="float64"), unit="s"),
+    })
+
+def get_record_frame(table):
+    cache = get_frame_cache()
+    version = get_data_version()
+    with cache["lock"]:
+        if cache["version"] != version:
+            cache["version"] = version
+            cache["frames"] = {}
+        if table not in cache["frames"]:
+            cache["frames"][table] = build_record_frame(table)
+        return cache["frames"][table]
+
+def filter_records(table, status="All", search="", added_by="All", date_range="All", has_screenshot=None):
+    """Records of a table matching the page filters, in storage order
+
+    Every filter is a boolean mask over the cached frame, so nothing is
+    parsed per record on a rerun.
+    """
+    frame = get_record_frame(table)
+    mask = pd.Series(True, index=frame.index)
+    if status != "All":
+        mask &= frame["status"] == status
+    if search:
+        mask &= (
+            frame["name"].str.contains(search.lower(), regex=False)
+            | frame["roll_number"].str.contains(search, regex=False)
+        )
+    if added_by != "All":
+        mask &= frame["added_by_admin"] == (added_by == "Admin")
+    if date_range != "All":
+        dates = frame["payment_datetime"].dt.normalize()
+        today = pd.Timestamp(datetime.now().date())
+        if date_range == "Today":
+            mask &= dates == today
+        elif date_range == "Last 7 Days":
+            mask &= (today - dates).dt.days <= 7
+        elif date_range == "This Month":
+            mask &= (dates.dt.year == today.year) & (dates.dt.month == today.month)
+    if has_screenshot is not None:
+        mask &= frame["has_screenshot"] == has_screenshot
+    records = get_index().tables[table]
+    return [records[record_id] for record_id in frame.loc[mask, "id"] if record_id in records]
+
+# Screenshot thumbnails
+def thumbnail_path(filename):
+    return THUMBNAILS_DIR / f"{Path(filename).stem}.jpg"
+
+@st.cache_resource
+def get_thumbnail_cache():
+    """Running size of THUMBNAILS_DIR, shared by every session"""
+    return {"bytes": None, "lock": threading.Lock()}
+
+def evict_thumbnails(added_bytes):
+    """Delete least recently used thumbnails once the cache outgrows its limit"""
+    cache = get_thumbnail_cache()
+    max_bytes = THUMBNAIL_CACHE_MAX_MB * 1024 * 1024
+    with cache["lock"]:
+        if cache["bytes"] is None:
+            cache["bytes"] = sum(f.stat().st_size for f in THUMBNAILS_DIR.glob("*.jpg"))
+        else:
+            cache["bytes"] += added_bytes
+        if cache["bytes"] <= max_bytes:
+            return
+        # Reads touch the mtime, so the oldest mtime is the least recently used
+        files = sorted(THUMBNAILS_DIR.glob("*.jpg"), key=lambda f: f.stat().st_mtime)
+        total = sum(f.stat().st_size for f in files)
+        for f in files:
+            if total <= max_bytes * 0.9:
+                break
+            total -= f.stat().st_size
+            f.unlink(missing_ok=True)
+        cache["bytes"] = total
+
+def open_image(source):
+    """Open an image from bytes or a file path"""
+    return Image.open(source if isinstance(source, Path) else io.BytesIO(source))
+
+def create_thumbnail(filename, source=None):
+    """Write a small JPEG preview of a screenshot and return its bytes"""
+    if source is None:
+        source = view_screenshot(filename)
+        if source is None:
+            return None
+    try:
+        with open_image(source) as img:
+            # Let JPEG decode at reduced size instead of full resolution
+            img.draft("RGB", (THUMBNAIL_MAX_SIZE, THUMBNAIL_MAX_SIZE))
+            img = img.convert("RGB")
+            img.thumbnail((THUMBNAIL_MAX_SIZE, THUMBNAIL_MAX_SIZE))
+            output = io.BytesIO()
+            img.save(output, "JPEG", quality=THUMBNAIL_QUALITY, optimize=True, progressive=True)
+    except Exception:
+        # Not a readable image; callers fall back to the original file
+        return None
+    thumb_bytes = output.getvalue()
+    THUMBNAILS_DIR.mkdir(exist_ok=True)
+    path = thumbnail_path(filename)
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    tmp_path.write_bytes(thumb_bytes)
+    os.replace(tmp_path, path)
+    evict_thumbnails(len(thumb_bytes))
+    return thumb_bytes
+
+def get_thumbnail(filename):
+    """Thumbnail bytes for a screenshot, created on first use for older uploads"""
+    if not filename:
+        return None
+    path = thumbnail_path(filename)
+    try:
+        thumb_bytes = path.read_bytes()
+        os.utime(path)
+        return thumb_bytes
+    except OSError:
+        return create_thumbnail(filename)
+
+# Screenshot similarity
+def perceptual_hash(source):
+    """64-bit difference hash (dHash) of an image, or None if it can't be read"""
+    try:
+        with open_image(source) as img:
+            pixels = list(img.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    except Exception:
+        return None
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+class BKTree:
+    """Burkhard-Keller tree over Hamming distance between perceptual hashes
+
+    Each node is [hash, values, children] with children keyed by their
+    distance to the node; the triangle inequality lets a radius search skip
+    every subtree that cannot hold a match.
+    """
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, key, value):
+        if self.root is None:
+            self.root = [key, {value}, {}]
+            return
+        node = self.root
+        while True:
+            distance = bin(node[0] ^ key).count("1")
+            if distance == 0:
+                node[1].add(value)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [key, {value}, {}]
+                return
+            node = child
+
+    def search(self, key, radius):
+        """(distance, value) pairs within radius of key"""
+        matches = []
+        pending = [self.root] if self.root is not None else []
+        while pending:
+            node = pending.pop()
+            distance = bin(node[0] ^ key).count("1")
+            if distance <= radius:
+                matches.extend((distance, value) for value in node[1])
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    pending.append(child)
+        return matches
+
+class PerceptualIndex:
+    """Perceptual hashes of stored screenshots, keyed by content hash
+
+    Entries are appended to PHASH_INDEX_FILE and replayed into a BK-tree;
+    each search first picks up lines other processes appended since the
+    last one. Entries are never removed: content hashes that no payment
+    references any more are dropped when results are mapped to payments.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = Path(file_path)
+        self.lock = threading.Lock()
+        self.offset = 0
+        self.tree = BKTree()
+        self.phashes = {}
+
+    def _sync(self):
+        try:
+            with open(self.file_path, "rb") as f:
+                f.seek(self.offset)
+                chunk = f.read()
+        except FileNotFoundError:
+            return
+        # Only consume whole lines; a partly written one is read next time
+        end = chunk.rfind(b"\n") + 1
+        for line in chunk[:end].splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            self._insert(entry["hash"], int(entry["phash"], 16))
+        self.offset += end
+
+    def _insert(self, content_hash, phash):
+        if content_hash not in self.phashes:
+            self.phashes[content_hash] = phash
+            self.tree.add(phash, content_hash)
+
+    def add(self, content_hash, phash):
+        with self.lock:
+            self._sync()
+            if content_hash in self.phashes:
+                return
+            with open(self.file_path, "a") as f:
+                f.write(json.dumps({"hash": content_hash, "phash": f"{phash:016x}"}) + "\n")
+            self._insert(content_hash, phash)
+
+    def get(self, content_hash):
+        with self.lock:
+            self._sync()
+            return self.phashes.get(content_hash)
+
+    def search(self, phash, radius=NEAR_DUPLICATE_DISTANCE):
+        with self.lock:
+            self._sync()
+            return self.tree.search(phash, radius)
+
+@st.cache_resource
+def get_perceptual_index():
+    return PerceptualIndex(PHASH_INDEX_FILE)
+
+def index_screenshot(content_hash, source):
+    """Add a stored screenshot to the perceptual index"""
+    phash = perceptual_hash(source)
+    if phash is not None:
+        get_perceptual_index().add(content_hash, phash)
+
+def find_similar_payments(content_hash, radius=NEAR_DUPLICATE_DISTANCE):
+    """(payment, distance) for payments whose screenshot looks like this one"""
+    index = get_perceptual_index()
+    phash = index.get(content_hash)
+    if phash is None:
+        return []
+    similar = []
+    for distance, other_hash in sorted(index.search(phash, radius)):
+        if other_hash != content_hash:
+            similar.extend((payment, distance) for payment in get_payments_by_screenshot_hash(other_hash))
+    return similar
+
+def find_near_duplicate_groups(radius=NEAR_DUPLICATE_DISTANCE):
+    """Pairs of distinct active screenshots that look alike, closest first"""
+    pairs = []
+    for content_hash in list(get_index().screenshot_payments):
+        for payment, distance in find_similar_payments(content_hash, radius):
+            other_hash = payment.get("screenshot_hash")
+            if content_hash < other_hash:
+                pairs.append((distance, content_hash, other_hash))
+    return sorted(set(pairs))
+
+def sniff_image_type(header):
+    """Extension for an image's leading bytes, or None if it isn't a known image"""
+    for signature, file_ext in IMAGE_SIGNATURES.items():
+        if header.startswith(signature):
+            return file_ext
+    return None
+
+def place_screenshot(temp_path, filename):
+    """Move a complete, fsynced temp file into the store unless it's already there"""
+    if screenshot_exists(filename):
+        temp_path.unlink()
+        return
+    filepath = upload_path(filename)
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(temp_path, filepath)
+    create_thumbnail(filename, filepath)
+
+def store_screenshot_bytes(img_bytes, filename):
+    """Write in-memory image data to the store through an fsynced temp file"""
+    temp_path = UPLOADS_DIR / f".upload-{uuid.uuid4().hex}.tmp"
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(img_bytes)
+            f.flush()
+            os.fsync(f.fileno())
+        place_screenshot(temp_path, filename)
+    except:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+def validate_upload(uploaded_file, max_size_mb):
+    """Check an upload's declared size and leading bytes; returns its extension"""
+    if uploaded_file.size > max_size_mb * 1024 * 1024:
+        raise ValueError(f"File size exceeds maximum allowed size of {max_size_mb}MB")
+    uploaded_file.seek(0)
+    file_ext = sniff_image_type(uploaded_file.read(16))
+    uploaded_file.seek(0)
+    if file_ext is None:
+        raise ValueError("Screenshot must be a PNG or JPEG image")
+    return file_ext
+
+def save_uploaded_file(uploaded_file):
+    """Stream an upload to disk under its SHA-256 so identical screenshots are kept once
+
+    The file type comes from its leading bytes rather than its name. Data
+    is hashed while it is copied in UPLOAD_CHUNK_SIZE pieces to a temp file,
+    which is fsynced and renamed into place only once complete.
+    """
+    max_size_mb = get_screenshot_settings().get("max_file_size_mb", 5)
     max_size_bytes = max_size_mb * 1024 * 1024
+    file_ext = validate_upload(uploaded_file, max_size_mb)
     
-    if uploaded_file.size > max_size_bytes:
-        raise ValueError(f"File size exceeds maximum allowed size of {max_size_mb}MB")
+    uploaded_file.seek(0)
+    chunk = uploaded_file.read(UPLOAD_CHUNK_SIZE)
+    digest = hashlib.sha256()
+    written = 0
+    temp_path = UPLOADS_DIR / f".upload-{uuid.uuid4().hex}.tmp"
+    try:
+        with open(temp_path, 'wb') as f:
+            while chunk:
+                written += len(chunk)
+                if written > max_size_bytes:
+                    raise ValueError(f"File size exceeds maximum allowed size of {max_size_mb}MB")
+                digest.update(chunk)
+                f.write(chunk)
+                chunk = uploaded_file.read(UPLOAD_CHUNK_SIZE)
+            f.flush()
+            os.fsync(f.fileno())
+        
+        filename = f"{digest.hexdigest()}.{file_ext}"
+        place_screenshot(temp_path, filename)
+    except:
+        temp_path.unlink(missing_ok=True)
+        raise
     
-    file_ext = uploaded_file.name.split('.')[-1]
-    filename = f"{student_id}_{uuid.uuid4()}.{file_ext}"
-    filepath = UPLOADS_DIR / filename
+    if get_perceptual_index().get(Path(filename).stem) is None:
+        index_screenshot(Path(filename).stem, find_screenshot(filename) or view_screenshot(filename))
     
-    with open(filepath, 'wb') as f:
-        f.write(uploaded_file.getbuffer())
+    return filename
+
+# Screenshot compression
+@st.cache_resource
+def get_screenshot_workers():
+    """Thread pool for screenshot processing that shouldn't hold up a request"""
+    return ThreadPoolExecutor(max_workers=SCREENSHOT_WORKERS)
+
+def transcode_screenshot(payment_id, filename, settings):
+    """Re-encode a payment's screenshot as JPEG and switch the payment to it if smaller
+
+    The original is kept as original_screenshot or deleted, depending on
+    settings. The payment keeps the content hash of what was uploaded, so
+    duplicate and similarity checks are unaffected.
+    """
+    source = find_screenshot(filename) or view_screenshot(filename)
+    if source is None:
+        return None
+    max_dimension = settings.get("compress_max_dimension", 1600)
+    try:
+        with open_image(source) as img:
+            img.draft("RGB", (max_dimension, max_dimension))
+            img = img.convert("RGB")
+            img.thumbnail((max_dimension, max_dimension))
+            output = io.BytesIO()
+            img.save(output, "JPEG", quality=settings.get("compress_quality", 75), optimize=True, progressive=True)
+    except Exception:
+        return None
+    
+    img_bytes = output.getvalue()
+    original_size = source.stat().st_size if isinstance(source, Path) else len(source)
+    if len(img_bytes) >= original_size:
+        return None
     
+    new_filename = f"{hashlib.sha256(img_bytes).hexdigest()}.jpg"
+    store_screenshot_bytes(img_bytes, new_filename)
+    
+    # The screenshot may have been deleted or replaced while we worked
+    payment = get_index().tables["payments"].get(payment_id)
+    if payment is None or payment.get("screenshot") != filename or payment.get("screenshot_deleted"):
+        delete_screenshot_file(new_filename)
+        return None
+    keep_original = settings.get("keep_original", True)
+    commit_operations([{"op": "update", "table": "payments", "id": payment_id, "fields": {
+        "screenshot": new_filename,
+        "original_screenshot": filename if keep_original else None,
+        "screenshot_compressed": True
+    }}])
+    # Same race as in process_screenshot if the JPEG matched a stored file
+    if not screenshot_exists(new_filename):
+        store_screenshot_bytes(img_bytes, new_filename)
+    if not keep_original:
+        delete_screenshot_file(filename)
+    return new_filename
+
+def schedule_compression(payment, settings=None):
+    """Queue a payment's screenshot for re-encoding if compression is enabled"""
+    settings = settings or get_screenshot_settings()
+    if not settings.get("compress_enabled") or not payment.get("screenshot"):
+        return None
+    if payment.get("screenshot_compressed") or payment.get("screenshot_deleted"):
+        return None
+    return get_screenshot_workers().submit(transcode_screenshot, payment["id"], payment["screenshot"], settings)
+
+# Background screenshot processing
+@st.cache_resource
+def get_screenshot_queue():
+    """Counts of this process's screenshot jobs; slots cap how many uploads wait in memory"""
+    return {
+        "slots": threading.BoundedSemaphore(SCREENSHOT_QUEUE_LIMIT),
+        "lock": threading.Lock(),
+        "queued": 0,
+        "running": 0,
+        "done": 0,
+        "failed": 0
+    }
+
+def spool_path(payment_id):
+    return SPOOL_DIR / f"{payment_id}.upload"
+
+def spool_upload(payment_id, uploaded_file):
+    """Write an upload to disk and fsync it before the submission is acknowledged"""
+    SPOOL_DIR.mkdir(exist_ok=True)
+    temp_path = SPOOL_DIR / f".{payment_id}.tmp"
+    uploaded_file.seek(0)
+    try:
+        with open(temp_path, 'wb') as f:
+            chunk = uploaded_file.read(UPLOAD_CHUNK_SIZE)
+            while chunk:
+                f.write(chunk)
+                chunk = uploaded_file.read(UPLOAD_CHUNK_SIZE)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, spool_path(payment_id))
+    except:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+def save_spooled_upload(payment_id):
+    with open(spool_path(payment_id), 'rb') as f:
+        f.size = os.fstat(f.fileno()).st_size
+        return save_uploaded_file(f)
+
+def process_screenshot(payment_id, settings):
+    """Store, hash and index a spooled screenshot and record it on the payment"""
+    try:
+        filename = save_spooled_upload(payment_id)
+    except Exception as e:
+        payment = get_index().tables["payments"].get(payment_id)
+        if isinstance(e, FileNotFoundError) and (payment or {}).get("screenshot_status") != "processing":
+            # Already handled, e.g. by another process recovering it
+            return None
+        commit_operations([{"op": "update", "table": "payments", "id": payment_id, "fields": {
+            "screenshot_status": "failed",
+            "screenshot_error": str(e)
+        }}])
+        spool_path(payment_id).unlink(missing_ok=True)
+        raise
+    
+    if get_index().tables["payments"].get(payment_id) is None:
+        # The payment was deleted while the file was being saved
+        spool_path(payment_id).unlink(missing_ok=True)
+        delete_screenshot_file(filename)
+        return None
+    
+    content_hash = Path(filename).stem
+    fields = {"screenshot": filename, "screenshot_hash": content_hash, "screenshot_status": "ready"}
+    # Flag screenshots that were already used for another payment
+    reused_by = [p.get("id") for p in get_payments_by_screenshot_hash(content_hash) if p.get("id") != payment_id]
+    if reused_by:
+        fields["duplicate_screenshot_of"] = reused_by
+    similar = [p.get("id") for p, _ in find_similar_payments(content_hash) if p.get("id") != payment_id]
+    if similar:
+        fields["similar_screenshot_of"] = similar
+    commit_operations([{"op": "update", "table": "payments", "id": payment_id, "fields": fields}])
+    # An identical file that was already stored may have been deleted along
+    # with its last other payment before this one referenced it
+    if not screenshot_exists(filename):
+        save_spooled_upload(payment_id)
+    spool_path(payment_id).unlink(missing_ok=True)
+    
+    if settings.get("compress_enabled"):
+        transcode_screenshot(payment_id, filename, settings)
     return filename
 
+def run_screenshot_job(payment_id, settings):
+    queue = get_screenshot_queue()
+    with queue["lock"]:
+        queue["queued"] -= 1
+        queue["running"] += 1
+    outcome = "failed"
+    try:
+        result = process_screenshot(payment_id, settings)
+        outcome = "done"
+        return result
+    finally:
+        with queue["lock"]:
+            queue["running"] -= 1
+            queue[outcome] += 1
+
+def submit_screenshot(payment_id, settings):
+    """Process a spooled screenshot on the worker pool, or right away if the queue is full"""
+    queue = get_screenshot_queue()
+    with queue["lock"]:
+        queue["queued"] += 1
+    if not queue["slots"].acquire(blocking=False):
+        # Too many uploads waiting; make this request do its own work
+        try:
+            return run_screenshot_job(payment_id, settings)
+        except Exception:
+            # The failure is recorded on the payment, which is already saved
+            return None
+    
+    def job():
+        try:
+            return run_screenshot_job(payment_id, settings)
+        finally:
+            queue["slots"].release()
+    
+    return get_screenshot_workers().submit(job)
+
+def recover_screenshot_jobs():
+    """Requeue spooled uploads left processing by a restart, and fail lost ones"""
+    settings = get_screenshot_settings()
+    cutoff = time.time() - SCREENSHOT_STALE_SECONDS
+    requeued = []
+    failed = []
+    for payment in get_payments():
+        if payment.get("screenshot_status") != "processing":
+            continue
+        if spool_path(payment["id"]).exists():
+            requeued.append(payment["id"])
+        elif (payment.get("submission_ts") or 0) < cutoff:
+            failed.append(payment["id"])
+    if failed:
+        commit_operations([
+            {"op": "update", "table": "payments", "id": payment_id, "fields": {
+                "screenshot_status": "failed",
+                "screenshot_error": "Upload was interrupted"
+            }}
+            for payment_id in failed
+        ])
+    for payment_id in requeued:
+        submit_screenshot(payment_id, settings)
+    # Spooled by a submission that crashed before its payment was saved
+    payments = get_index().tables["payments"]
+    if SPOOL_DIR.exists():
+        for leftover in SPOOL_DIR.iterdir():
+            if leftover.stem.lstrip(".") not in payments and leftover.stat().st_mtime < cutoff:
+                leftover.unlink(missing_ok=True)
+    return len(requeued), len(failed)
+
+@st.cache_resource
+def run_screenshot_recovery():
+    """Recover once per process"""
+    return recover_screenshot_jobs()
+
+def show_missing_screenshot(payment, message="No screenshot"):
+    """Explain why a payment has no screenshot to show"""
+    status = payment.get("screenshot_status")
+    if status == "processing":
+        st.info("⏳ Processing upload")
+    elif status == "failed":
+        st.error("❌ Upload failed")
+    else:
+        st.info(message)
+
+def backfill_screenshot_hashes():
+    """Record content and perceptual hashes for screenshots uploaded before hashing existed"""
+    ops = []
+    perceptual_index = get_perceptual_index()
+    for payment in get_payments():
+        filename = payment.get("screenshot")
+        if not filename or payment.get("screenshot_deleted"):
+            continue
+        content_hash = payment.get("screenshot_hash")
+        if content_hash and perceptual_index.get(content_hash) is not None:
+            continue
+        img_bytes = view_screenshot(filename)
+        if img_bytes is None:
+            continue
+        if not content_hash:
+            content_hash = hashlib.sha256(img_bytes).hexdigest()
+            ops.append({"op": "update", "table": "payments", "id": payment["id"], "fields": {"screenshot_hash": content_hash}})
+        index_screenshot(content_hash, img_bytes)
+    if ops:
+        commit_operations(ops)
+    return len(ops)
+
 def get_instructions():
     return load_data(INSTRUCTIONS_FILE, "")
 
@@ -384,6 +2261,8 @@ def save_instructions(instructions):
 # Main app
 def main():
     init_files()
+    run_timestamp_backfill()
+    run_screenshot_recovery()
     
     # Check if student panel should be shown
     query_params = get_query_params()
@@ -628,8 +2507,7 @@ def show_submit_payment_section(payment_amount, payment_accounts, screenshot_set
                 st.error("No payment accounts available. Please contact administrator.")
             else:
                 # Check if roll number already exists
-                students = get_students()
-                existing = any(s.get("roll_number") == roll_number for s in students)
+                existing = get_student_by_roll(roll_number) is not None
                 
                 if existing:
                     st.error("This roll number has already submitted payment")
@@ -655,14 +2533,15 @@ def show_submit_payment_section(payment_amount, payment_accounts, screenshot_set
                             "screenshot_deleted": False
                         }
                         
-                        # Save payment record
-                        filename = save_uploaded_file(payment_screenshot, student_id)
+                        # Reject bad uploads now; the file itself is stored in the background
+                        validate_upload(payment_screenshot, max_file_size)
                         payment_data = {
                             "id": str(uuid.uuid4()),
                             "student_id": student_id,
                             "transaction_id": transaction_id,
                             "amount": payment_amount,
-                            "screenshot": filename,
+                            "screenshot": None,
+                            "screenshot_status": "processing",
                             "screenshot_deleted": False,
                             "status": "Pending",
                             "submission_date": datetime.now().isoformat(),
@@ -673,13 +2552,22 @@ def show_submit_payment_section(payment_amount, payment_accounts, screenshot_set
                             "auto_timestamp": True  # Flag to indicate auto-generated timestamp
                         }
                         
-                        # Save data
-                        students.append(student_data)
-                        save_students(students)
+                        # On disk before the payment exists, so a restart can't lose it
+                        spool_upload(payment_data["id"], payment_screenshot)
                         
-                        payments = get_payments()
-                        payments.append(payment_data)
-                        save_payments(payments)
+                        # Save data; the roll number is re-checked under the storage lock
+                        try:
+                            commit_operations([
+                                {"op": "insert", "table": "students", "record": student_data, "unique": ["roll_number"]},
+                                {"op": "insert", "table": "payments", "record": payment_data}
+                            ])
+                        except DuplicateRecordError:
+                            spool_path(payment_data["id"]).unlink(missing_ok=True)
+                            raise DuplicateRecordError("This roll number has already submitted payment")
+                        except:
+                            spool_path(payment_data["id"]).unlink(missing_ok=True)
+                            raise
+                        submit_screenshot(payment_data["id"], screenshot_settings)
                         
                         st.success("Payment submitted successfully! Your payment is under review.")
                         st.info(f"Submission timestamp: {formatted_time}")
@@ -694,6 +2582,9 @@ def show_payment_status_section():
     
     roll_number = st.text_input("Enter your Roll Number to check status")
     if st.button("Check Status") and roll_number:
+        st.session_state["checked_roll_number"] = roll_number
+    # Kept across reruns so buttons inside the results (e.g. Prepare Download) work
+    if roll_number and st.session_state.get("checked_roll_number") == roll_number:
         student = get_student_by_roll(roll_number)
         
         if student:
@@ -759,14 +2650,11 @@ def show_payment_status_section():
                         elif payment.get("screenshot"):
                             screenshot_settings = get_screenshot_settings()
                             if screenshot_settings.get("allow_download", True):
-                                screenshot_path = UPLOADS_DIR / payment.get("screenshot")
-                                if screenshot_path.exists():
-                                    with open(screenshot_path, "rb") as f:
-                                        img_bytes = f.read()
-                                    st.download_button(
-                                        "📥 Download Screenshot",
-                                        img_bytes,
-                                        file_name=payment.get("screenshot"),
+                                screenshot_stored = screenshot_exists(payment.get("screenshot"))
+                                if screenshot_stored:
+                                    show_screenshot_download(
+                                        payment,
+                                        label="📥 Download Screenshot",
                                         key=f"student_download_{payment['id']}",
                                         help="Download the payment screenshot"
                                     )
@@ -775,7 +2663,7 @@ def show_payment_status_section():
                             else:
                                 st.info("📸 Screenshot is available (download disabled by admin)")
                         else:
-                            st.info("📸 No screenshot uploaded")
+                            show_missing_screenshot(payment, "📸 No screenshot uploaded")
                         
                         if payment.get("student_remarks"):
                             st.write(f"**Your Remarks:** {payment.get('student_remarks')}")
@@ -802,10 +2690,14 @@ def show_student_list_section():
                         "Roll Number": s["roll_number"],
                         "Status": "Paid",
                         "Account Used": s.get("payment_account_used", "Not specified"),
-                        "Payment Date": format_datetime(s.get("payment_datetime", "")),
-                        "Registration Date": format_datetime(s.get("registration_date", ""))
+                        "Payment Date": payment_date,
+                        "Registration Date": registration_date
                     } 
-                    for s in paid_students
+                    for s, payment_date, registration_date in zip(
+                        paid_students,
+                        format_record_datetimes(paid_students, "payment_datetime"),
+                        format_record_datetimes(paid_students, "registration_date")
+                    )
                 ])
                 st.dataframe(df_paid, use_container_width=True)
             else:
@@ -820,10 +2712,14 @@ def show_student_list_section():
                         "Roll Number": s["roll_number"],
                         "Status": s.get("payment_status", "Pending"),
                         "Account Used": s.get("payment_account_used", "Not specified"),
-                        "Payment Date": format_datetime(s.get("payment_datetime", "")),
-                        "Registration Date": format_datetime(s.get("registration_date", ""))
+                        "Payment Date": payment_date,
+                        "Registration Date": registration_date
                     } 
-                    for s in unpaid_students
+                    for s, payment_date, registration_date in zip(
+                        unpaid_students,
+                        format_record_datetimes(unpaid_students, "payment_datetime"),
+                        format_record_datetimes(unpaid_students, "registration_date")
+                    )
                 ])
                 st.dataframe(df_unpaid, use_container_width=True)
             else:
@@ -997,6 +2893,98 @@ def show_admin_dashboard():
     with col3:
         st.info(f"**Max Size:** {max_size}MB")
     
+    # Review queue for pending submissions
+    st.divider()
+    st.subheader("Review Queue")
+    
+    pending_payments = [p for p in payments if p.get("status") == "Pending"]
+    if pending_payments:
+        col1, col2 = st.columns(2)
+        with col1:
+            review_search = st.text_input("Search by name, roll number or transaction ID", key="review_search")
+        with col2:
+            review_accounts = sorted({p.get("payment_account") or "Not specified" for p in pending_payments})
+            review_account = st.selectbox("Filter by Payment Account", ["All"] + review_accounts, key="review_account")
+        
+        review_rows = []
+        review_payments = []
+        for payment in pending_payments:
+            student = get_student_by_id(payment.get("student_id"))
+            if not student:
+                continue
+            account = payment.get("payment_account") or "Not specified"
+            if review_account != "All" and account != review_account:
+                continue
+            searchable = f"{student.get('name')} {student.get('roll_number')} {payment.get('transaction_id')}".lower()
+            if review_search and review_search.lower() not in searchable:
+                continue
+            review_rows.append({
+                "Select": False,
+                "Student ID": student.get("id"),
+                "Name": student.get("name"),
+                "Roll Number": student.get("roll_number"),
+                "Transaction ID": payment.get("transaction_id"),
+                "Amount": payment.get("amount"),
+                "Payment Account": account,
+                "Submitted": None,
+                "Flags": "⚠️ Duplicate screenshot" if get_screenshot_duplicates(payment) else ""
+            })
+            review_payments.append(payment)
+        for row, submitted in zip(review_rows, format_record_datetimes(review_payments, "submission_date")):
+            row["Submitted"] = submitted
+        
+        if review_rows:
+            # Ticks live outside the editor so other writes and filter changes keep them
+            selection = st.session_state.setdefault("review_selection", set())
+            shown_ids = [row["Student ID"] for row in review_rows]
+            
+            col1, col2 = st.columns(2)
+            with col1:
+                if st.button(f"Select All {len(review_rows)} Shown", key="review_select_all"):
+                    selection.update(shown_ids)
+                    st.session_state["review_generation"] = st.session_state.get("review_generation", 0) + 1
+            with col2:
+                if st.button("Clear Selection", key="review_clear_selection"):
+                    selection.clear()
+                    st.session_state["review_generation"] = st.session_state.get("review_generation", 0) + 1
+            
+            review_df = pd.DataFrame(review_rows)
+            review_df["Select"] = [student_id in selection for student_id in shown_ids]
+            # Same rows keep the same editor; new rows start from the saved ticks
+            rows_key = hashlib.sha1("|".join(shown_ids).encode()).hexdigest()[:12]
+            edited_df = st.data_editor(
+                review_df,
+                hide_index=True,
+                use_container_width=True,
+                disabled=[column for column in review_df.columns if column != "Select"],
+                column_config={"Student ID": None},
+                key=f"review_queue_{rows_key}_{st.session_state.get('review_generation', 0)}"
+            )
+            for student_id, selected in zip(edited_df["Student ID"], edited_df["Select"]):
+                if selected:
+                    selection.add(student_id)
+                else:
+                    selection.discard(student_id)
+            selected_ids = [student_id for student_id in shown_ids if student_id in selection]
+            
+            col1, col2, col3 = st.columns([1, 1, 2])
+            with col1:
+                if st.button(f"✅ Approve Selected ({len(selected_ids)})", disabled=not selected_ids, use_container_width=True):
+                    count = update_payment_statuses(selected_ids, "Paid")
+                    selection.difference_update(selected_ids)
+                    st.toast(f"Approved {count} payments", icon="✅")
+                    st.rerun()
+            with col2:
+                if st.button(f"❌ Reject Selected ({len(selected_ids)})", disabled=not selected_ids, use_container_width=True):
+                    count = update_payment_statuses(selected_ids, "Unpaid")
+                    selection.difference_update(selected_ids)
+                    st.toast(f"Rejected {count} payments", icon="❌")
+                    st.rerun()
+        else:
+            st.info("No pending payments match your filters")
+    else:
+        st.success("No payments waiting for review")
+    
     # Recent submissions
     st.divider()
     st.subheader("Recent Payment Submissions")
@@ -1012,137 +3000,159 @@ def show_admin_dashboard():
         for payment in recent_payments:
             student = get_student_by_id(payment.get("student_id"))
             if student:
-                payment_date = format_datetime(payment.get("payment_datetime", payment.get("submission_date")))
-                with st.expander(f"{student.get('name')} - {payment_date}"):
-                    cols = st.columns(4)
-                    cols[0].write(f"**Roll:** {student.get('roll_number')}")
-                    cols[1].write(f"**Amount:** PKR {payment.get('amount')}")
-                    cols[2].write(f"**Status:** {payment.get('status')}")
-                    cols[3].write(f"**Txn ID:** {payment.get('transaction_id')}")
-                    
-                    # Show payment date and time
-                    if payment.get("payment_datetime"):
-                        formatted_datetime = format_datetime(payment.get("payment_datetime"))
-                        if payment.get("auto_timestamp"):
-                            st.write(f"**Submission Timestamp:** {formatted_datetime} (Auto-recorded)")
-                        else:
-                            st.write(f"**Payment Date & Time:** {formatted_datetime}")
-                    
-                    # Show submission date
-                    submission_date = format_datetime(payment.get("submission_date"))
-                    st.write(f"**Form Submission Date:** {submission_date}")
-                    
-                    if payment.get("payment_account"):
-                        st.write(f"**Payment Account:** {payment.get('payment_account')}")
-                    
-                    # Show who submitted
-                    submitted_by = "Admin" if payment.get("added_by_admin") else "Student"
-                    st.write(f"**Submitted by:** {submitted_by}")
-                    
-                    # Show timestamp type
-                    if payment.get("auto_timestamp"):
-                        st.write("**Timestamp Type:** Auto-generated (Student submission)")
-                    else:
-                        st.write("**Timestamp Type:** Manually set by Admin")
-                    
-                    # Screenshot management section
-                    st.divider()
-                    st.subheader("Screenshot Management")
-                    
-                    col1, col2, col3, col4 = st.columns(4)
-                    
-                    with col1:
-                        # View screenshot button
-                        if payment.get("screenshot") and not payment.get("screenshot_deleted"):
-                            screenshot_path = UPLOADS_DIR / payment.get("screenshot")
-                            if screenshot_path.exists():
-                                with open(screenshot_path, "rb") as f:
-                                    img_bytes = f.read()
-                                
-                                # Display image in a modal or directly
-                                if st.button("👁️ View", key=f"view_{payment['id']}", use_container_width=True):
-                                    st.image(img_bytes, caption="Payment Screenshot", use_column_width=True)
-                            else:
-                                st.warning("File not found")
-                        elif payment.get("screenshot_deleted"):
-                            st.warning("❌ Deleted")
-                        else:
-                            st.info("No screenshot")
-                    
-                    with col2:
-                        # Download screenshot button
-                        if payment.get("screenshot") and not payment.get("screenshot_deleted"):
-                            screenshot_path = UPLOADS_DIR / payment.get("screenshot")
-                            if screenshot_path.exists():
-                                with open(screenshot_path, "rb") as f:
-                                    img_bytes = f.read()
-                                
-                                if screenshot_settings.get("allow_download", True):
-                                    st.download_button(
-                                        "📥 Download",
-                                        img_bytes,
-                                        file_name=payment.get("screenshot"),
-                                        key=f"download_{payment['id']}",
-                                        use_container_width=True
-                                    )
-                                else:
-                                    st.warning("Download disabled")
-                            else:
-                                st.warning("File not found")
-                        elif payment.get("screenshot_deleted"):
-                            st.warning("❌ Deleted")
-                        else:
-                            st.info("No screenshot")
-                    
-                    with col3:
-                        # Delete screenshot button
-                        if payment.get("screenshot") and not payment.get("screenshot_deleted"):
-                            if screenshot_settings.get("allow_delete", True):
-                                if st.button("🗑️ Delete", key=f"delete_{payment['id']}", type="secondary", use_container_width=True):
-                                    if delete_screenshot_file(payment.get("screenshot")):
-                                        remove_screenshot_from_payment(payment.get("id"))
-                                        remove_screenshot_from_student(payment.get("student_id"))
-                                        st.success("Screenshot deleted successfully!")
-                                        st.rerun()
-                                    else:
-                                        st.error("Failed to delete screenshot")
-                            else:
-                                st.warning("Delete disabled")
-                        elif payment.get("screenshot_deleted"):
-                            st.info("Already deleted")
-                        else:
-                            st.info("No screenshot")
-                    
-                    with col4:
-                        # Quick actions for payment status
-                        col_status1, col_status2 = st.columns(2)
-                        with col_status1:
-                            if payment.get("status") != "Paid":
-                                if st.button("✅ Approve", key=f"approve_{payment['id']}", use_container_width=True):
-                                    update_payment_status(student.get("id"), "Paid")
-                                    st.rerun()
-                        with col_status2:
-                            if payment.get("status") != "Unpaid":
-                                if st.button("❌ Reject", key=f"reject_{payment['id']}", use_container_width=True):
-                                    update_payment_status(student.get("id"), "Unpaid")
-                                    st.rerun()
+                payment_date = format_datetime(payment.get("payment_datetime", payment.get("submission_date")))
+                with st.expander(f"{student.get('name')} - {payment_date}"):
+                    show_payment_actions(payment["id"])
     else:
         st.info("No payment submissions yet")
 
-def update_payment_status(student_id, status):
-    students = get_students()
-    for student in students:
-        if student.get("id") == student_id:
-            student["payment_status"] = status
-            break
-    save_students(students)
+@fragment
+def show_payment_actions(payment_id):
+    """Details and actions for one submission; its buttons rerun only this panel"""
+    payment = get_index().tables["payments"].get(payment_id)
+    student = get_student_by_id(payment.get("student_id")) if payment else None
+    if student is None:
+        st.info("Payment has been deleted")
+        return
+    screenshot_settings = get_screenshot_settings()
     
-    payments = get_payments()
-    for payment in payments:
-        if payment.get("student_id") == student_id:
-            payment["status"] = status
-            break
-    save_payments(payments)
+    cols = st.columns(4)
+    cols[0].write(f"**Roll:** {student.get('roll_number')}")
+    cols[1].write(f"**Amount:** PKR {payment.get('amount')}")
+    cols[2].write(f"**Status:** {payment.get('status')}")
+    cols[3].write(f"**Txn ID:** {payment.get('transaction_id')}")
+    
+    # Show payment date and time
+    if payment.get("payment_datetime"):
+        formatted_datetime = format_datetime(payment.get("payment_datetime"))
+        if payment.get("auto_timestamp"):
+            st.write(f"**Submission Timestamp:** {formatted_datetime} (Auto-recorded)")
+        else:
+            st.write(f"**Payment Date & Time:** {formatted_datetime}")
+    
+    # Show submission date
+    submission_date = format_datetime(payment.get("submission_date"))
+    st.write(f"**Form Submission Date:** {submission_date}")
+    
+    if payment.get("payment_account"):
+        st.write(f"**Payment Account:** {payment.get('payment_account')}")
+    
+    # Show who submitted
+    submitted_by = "Admin" if payment.get("added_by_admin") else "Student"
+    st.write(f"**Submitted by:** {submitted_by}")
+    
+    # Show timestamp type
+    if payment.get("auto_timestamp"):
+        st.write("**Timestamp Type:** Auto-generated (Student submission)")
+    else:
+        st.write("**Timestamp Type:** Manually set by Admin")
+    
+    # Warn when the same screenshot was submitted for other payments
+    duplicates = get_screenshot_duplicates(payment)
+    if duplicates:
+        rolls = []
+        for other in duplicates:
+            other_student = get_student_by_id(other.get("student_id"))
+            rolls.append(other_student.get("roll_number") if other_student else "Unknown")
+        st.warning(f"⚠️ Same screenshot also submitted by: {', '.join(rolls)}")
+    similar = find_similar_payments(screenshot_key(payment)) if screenshot_key(payment) else []
+    if similar:
+        matches = []
+        for other, distance in similar:
+            other_student = get_student_by_id(other.get("student_id"))
+            matches.append(f"{other_student.get('roll_number') if other_student else 'Unknown'} ({distance} bits apart)")
+        st.warning(f"🔎 Similar screenshot submitted by: {', '.join(matches)}")
+    
+    # Screenshot management section
+    st.divider()
+    st.subheader("Screenshot Management")
+    
+    col1, col2, col3, col4 = st.columns(4)
+    
+    with col1:
+        # View screenshot button
+        if payment.get("screenshot") and not payment.get("screenshot_deleted"):
+            screenshot_stored = screenshot_exists(payment.get("screenshot"))
+            if screenshot_stored:
+                # Thumbnail preview, read only when asked
+                show_screenshot_preview(payment, key=f"view_{payment['id']}", use_container_width=True)
+            else:
+                st.warning("File not found")
+        elif payment.get("screenshot_deleted"):
+            st.warning("❌ Deleted")
+        else:
+            show_missing_screenshot(payment)
+    
+    with col2:
+        # Download screenshot button
+        if payment.get("screenshot") and not payment.get("screenshot_deleted"):
+            screenshot_stored = screenshot_exists(payment.get("screenshot"))
+            if screenshot_stored:
+                if screenshot_settings.get("allow_download", True):
+                    show_screenshot_download(
+                        payment,
+                        key=f"download_{payment['id']}",
+                        use_container_width=True
+                    )
+                else:
+                    st.warning("Download disabled")
+            else:
+                st.warning("File not found")
+        elif payment.get("screenshot_deleted"):
+            st.warning("❌ Deleted")
+        else:
+            show_missing_screenshot(payment)
+    
+    with col3:
+        # Delete screenshot button
+        if payment.get("screenshot") and not payment.get("screenshot_deleted"):
+            if screenshot_settings.get("allow_delete", True):
+                if st.button("🗑️ Delete", key=f"delete_{payment['id']}", type="secondary", use_container_width=True):
+                    if delete_payment_screenshots(payment, {payment.get("id")}):
+                        remove_screenshot_from_payment(payment.get("id"))
+                        remove_screenshot_from_student(payment.get("student_id"))
+                        st.success("Screenshot deleted successfully!")
+                        rerun_fragment()
+                    else:
+                        st.error("Failed to delete screenshot")
+            else:
+                st.warning("Delete disabled")
+        elif payment.get("screenshot_deleted"):
+            st.info("Already deleted")
+        else:
+            show_missing_screenshot(payment)
+    
+    with col4:
+        # Quick actions for payment status
+        col_status1, col_status2 = st.columns(2)
+        with col_status1:
+            if payment.get("status") != "Paid":
+                if st.button("✅ Approve", key=f"approve_{payment['id']}", use_container_width=True):
+                    update_payment_status(student.get("id"), "Paid")
+                    rerun_fragment()
+        with col_status2:
+            if payment.get("status") != "Unpaid":
+                if st.button("❌ Reject", key=f"reject_{payment['id']}", use_container_width=True):
+                    update_payment_status(student.get("id"), "Unpaid")
+                    rerun_fragment()
+
+def update_payment_status(student_id, status):
+    update_payment_statuses([student_id], status)
+
+def update_payment_statuses(student_ids, status):
+    """Set the status of many students and all of their payments in one commit
+
+    Returns how many payments were updated.
+    """
+    ops = []
+    payment_count = 0
+    for student_id in dict.fromkeys(student_ids):
+        payment_count += len(get_student_payments(student_id))
+        ops.append({"op": "update", "table": "students", "id": student_id, "fields": {"payment_status": status}})
+        ops.append({"op": "update", "table": "payments", "where": {"student_id": student_id}, "fields": {"status": status}})
+    if ops:
+        commit_operations(ops)
+    return payment_count
 
 def show_student_management():
     st.title("👥 Student Management")
@@ -1165,54 +3175,46 @@ def show_student_management():
                 date_filter = st.selectbox("Filter by Date", ["All", "Today", "Last 7 Days", "This Month"])
             
             # Apply filters
-            filtered_students = students
-            if filter_status != "All":
-                filtered_students = [s for s in filtered_students if s.get("payment_status") == filter_status]
-            if search_term:
-                filtered_students = [s for s in filtered_students 
-                                   if search_term.lower() in s.get("name", "").lower() 
-                                   or search_term in s.get("roll_number", "")]
-            if filter_added_by != "All":
-                if filter_added_by == "Admin":
-                    filtered_students = [s for s in filtered_students if s.get("added_by_admin") == True]
-                else:
-                    filtered_students = [s for s in filtered_students if s.get("added_by_admin") != True]
-            
-            # Date filter
-            if date_filter != "All":
-                today = datetime.now().date()
-                filtered_by_date = []
-                for student in filtered_students:
-                    payment_datetime = student.get("payment_datetime")
-                    if payment_datetime:
-                        try:
-                            payment_date = datetime.fromisoformat(payment_datetime).date()
-                            if date_filter == "Today" and payment_date == today:
-                                filtered_by_date.append(student)
-                            elif date_filter == "Last 7 Days" and (today - payment_date).days <= 7:
-                                filtered_by_date.append(student)
-                            elif date_filter == "This Month" and payment_date.month == today.month and payment_date.year == today.year:
-                                filtered_by_date.append(student)
-                        except:
-                            pass
-                filtered_students = filtered_by_date
+            filtered_students = filter_records(
+                "students",
+                status=filter_status,
+                search=search_term,
+                added_by=filter_added_by,
+                date_range=date_filter
+            )
             
             # Display students in a table
             if filtered_students:
+                # Sort with the id as a tie-breaker so pages stay stable
+                sort_by = st.selectbox("Sort by", ["Registration Order", "Name", "Roll Number", "Newest First"], key="manage_sort")
+                if sort_by == "Name":
+                    filtered_students = sorted(filtered_students, key=lambda s: (s.get("name", "").lower(), s.get("id")))
+                elif sort_by == "Roll Number":
+                    filtered_students = sorted(filtered_students, key=lambda s: (s.get("roll_number", ""), s.get("id")))
+                elif sort_by == "Newest First":
+                    filtered_students = sorted(filtered_students, key=lambda s: (s.get("registration_date", ""), s.get("id")), reverse=True)
+                
+                st.info(f"Found {len(filtered_students)} students matching your criteria")
+                page_students = paginate(filtered_students, "manage")
+                
                 # Create DataFrame for better display
                 df = pd.DataFrame([
                     {
                         "Name": s.get("name", ""),
                         "Roll Number": s.get("roll_number", ""),
                         "Payment Status": s.get("payment_status", "Pending"),
-                        "Payment Date": format_datetime(s.get("payment_datetime", "")),
+                        "Payment Date": payment_date,
                         "Timestamp Type": "Auto" if s.get("auto_timestamp") else "Manual",
                         "Account Used": s.get("payment_account_used", "Not specified"),
                         "Admin Remarks": s.get("admin_remarks", ""),
                         "Added By": "Admin" if s.get("added_by_admin") else "Student",
-                        "Registration Date": format_datetime(s.get("registration_date", ""))
+                        "Registration Date": registration_date
                     }
-                    for s in filtered_students
+                    for s, payment_date, registration_date in zip(
+                        page_students,
+                        format_record_datetimes(page_students, "payment_datetime"),
+                        format_record_datetimes(page_students, "registration_date")
+                    )
                 ])
                 
                 # Display the dataframe
@@ -1220,254 +3222,9 @@ def show_student_management():
                 
                 # Individual student management below the table
                 st.subheader("Manage Individual Students")
-                for student in filtered_students:
+                for student in page_students:
                     with st.expander(f"Manage: {student.get('name')} (Roll: {student.get('roll_number')})"):
-                        col1, col2, col3, col4 = st.columns([2, 2, 2, 2])
-                        
-                        with col1:
-                            st.write(f"**Name:** {student.get('name')}")
-                        with col2:
-                            st.write(f"**Roll Number:** {student.get('roll_number')}")
-                        with col3:
-                            added_by = "Admin" if student.get("added_by_admin") else "Student"
-                            st.write(f"**Added By:** {added_by}")
-                        with col4:
-                            status = student.get("payment_status", "Pending")
-                            color = {"Paid": "green", "Unpaid": "red", "Pending": "orange"}.get(status, "gray")
-                            st.markdown(f"**Status:** <span style='color:{color}'>{status}</span>", 
-                                      unsafe_allow_html=True)
-                        
-                        # Show payment date and time
-                        if student.get("payment_datetime"):
-                            formatted_datetime = format_datetime(student.get("payment_datetime"))
-                            timestamp_type = "Auto-generated (Student submission)" if student.get("auto_timestamp") else "Manually set by Admin"
-                            st.info(f"**Payment Date & Time:** {formatted_datetime}")
-                            st.info(f"**Timestamp Type:** {timestamp_type}")
-                        
-                        # Show payment account used
-                        if student.get("payment_account_used"):
-                            st.info(f"**Payment Account Used:** {student.get('payment_account_used')}")
-                        
-                        # Check if screenshot was deleted
-                        if student.get("screenshot_deleted"):
-                            st.warning("⚠️ Payment screenshot has been deleted")
-                        
-                        # Show payment history with screenshot management
-                        st.subheader("Payment History & Screenshot Management")
-                        payments = get_student_payments(student.get("id"))
-                        if payments:
-                            for payment in payments:
-                                with st.expander(f"Payment: {payment.get('transaction_id')} - {payment.get('status')}"):
-                                    col_info1, col_info2 = st.columns(2)
-                                    with col_info1:
-                                        st.write(f"**Amount:** PKR {payment.get('amount')}")
-                                        st.write(f"**Date:** {format_datetime(payment.get('payment_datetime'))}")
-                                    with col_info2:
-                                        st.write(f"**Account:** {payment.get('payment_account')}")
-                                        st.write(f"**Status:** {payment.get('status')}")
-                                    
-                                    # Screenshot section
-                                    st.write("**Screenshot:**")
-                                    screenshot_settings = get_screenshot_settings()
-                                    
-                                    if payment.get("screenshot_deleted"):
-                                        st.warning("🗑️ Screenshot has been deleted")
-                                    elif payment.get("screenshot"):
-                                        col_ss1, col_ss2, col_ss3 = st.columns(3)
-                                        
-                                        with col_ss1:
-                                            # View button
-                                            screenshot_path = UPLOADS_DIR / payment.get("screenshot")
-                                            if screenshot_path.exists():
-                                                with open(screenshot_path, "rb") as f:
-                                                    img_bytes = f.read()
-                                                if st.button("👁️ View", key=f"view_payment_{payment['id']}", use_container_width=True):
-                                                    st.image(img_bytes, caption="Payment Screenshot", use_column_width=True)
-                                            else:
-                                                st.warning("File not found")
-                                        
-                                        with col_ss2:
-                                            # Download button
-                                            if screenshot_path.exists():
-                                                with open(screenshot_path, "rb") as f:
-                                                    img_bytes = f.read()
-                                                if screenshot_settings.get("allow_download", True):
-                                                    st.download_button(
-                                                        "📥 Download",
-                                                        img_bytes,
-                                                        file_name=payment.get("screenshot"),
-                                                        key=f"download_payment_{payment['id']}",
-                                                        use_container_width=True
-                                                    )
-                                                else:
-                                                    st.warning("Download disabled")
-                                            else:
-                                                st.warning("File not found")
-                                        
-                                        with col_ss3:
-                                            # Delete button
-                                            if screenshot_settings.get("allow_delete", True):
-                                                if st.button("🗑️ Delete", key=f"delete_payment_{payment['id']}", type="secondary", use_container_width=True):
-                                                    if delete_screenshot_file(payment.get("screenshot")):
-                                                        remove_screenshot_from_payment(payment.get("id"))
-                                                        remove_screenshot_from_student(payment.get("student_id"))
-                                                        st.success("Screenshot deleted successfully!")
-                                                        st.rerun()
-                                                    else:
-                                                        st.error("Failed to delete screenshot")
-                                            else:
-                                                st.warning("Delete disabled")
-                                    else:
-                                        st.info("No screenshot uploaded")
-                                    
-                                    # Quick status update
-                                    col_status1, col_status2 = st.columns(2)
-                                    with col_status1:
-                                        if payment.get("status") != "Paid":
-                                            if st.button("✅ Mark as Paid", key=f"paid_{payment['id']}", use_container_width=True):
-                                                payment["status"] = "Paid"
-                                                save_payments(payments)
-                                                student["payment_status"] = "Paid"
-                                                save_students(students)
-                                                st.success("Payment marked as Paid!")
-                                                st.rerun()
-                                    with col_status2:
-                                        if payment.get("status") != "Unpaid":
-                                            if st.button("❌ Mark as Unpaid", key=f"unpaid_{payment['id']}", use_container_width=True):
-                                                payment["status"] = "Unpaid"
-                                                save_payments(payments)
-                                                student["payment_status"] = "Unpaid"
-                                                save_students(students)
-                                                st.success("Payment marked as Unpaid!")
-                                                st.rerun()
-                        
-                        # Update payment date and time (Admin can modify)
-                        st.subheader("Update Payment Date & Time")
-                        st.warning("Admin can modify the payment timestamp if needed")
-                        
-                        col1, col2 = st.columns(2)
-                        with col1:
-                            if student.get("payment_datetime"):
-                                current_dt = datetime.fromisoformat(student.get("payment_datetime"))
-                            else:
-                                current_dt = datetime.now()
-                            
-                            new_payment_date = st.date_input(
-                                "New Payment Date",
-                                value=current_dt.date(),
-                                key=f"date_{student['id']}"
-                            )
-                        with col2:
-                            new_payment_time = st.time_input(
-                                "New Payment Time",
-                                value=current_dt.time(),
-                                key=f"time_{student['id']}"
-                            )
-                        
-                        new_payment_datetime = datetime.combine(new_payment_date, new_payment_time)
-                        
-                        if new_payment_datetime.isoformat() != student.get("payment_datetime"):
-                            if st.button("Update Payment Date/Time", key=f"update_dt_{student['id']}"):
-                                student["payment_datetime"] = new_payment_datetime.isoformat()
-                                student["auto_timestamp"] = False  # Mark as manually set by admin
-                                
-                                # Update payment record if exists
-                                payments = get_payments()
-                                for payment in payments:
-                                    if payment.get("student_id") == student.get("id"):
-                                        payment["payment_datetime"] = new_payment_datetime.isoformat()
-                                        payment["auto_timestamp"] = False  # Mark as manually set by admin
-                                        break
-                                save_payments(payments)
-                                
-                                save_students(students)
-                                st.success("Payment date/time updated!")
-                                st.rerun()
-                        
-                        # Status update section
-                        st.subheader("Update Payment Status")
-                        col1, col2 = st.columns([3, 1])
-                        with col1:
-                            # Status update dropdown
-                            new_status = st.selectbox(
-                                "Update Status",
-                                ["Paid", "Unpaid", "Pending"],
-                                index=["Paid", "Unpaid", "Pending"].index(status),
-                                key=f"status_{student['id']}"
-                            )
-                        with col2:
-                            st.write("")  # Spacer
-                            if new_status != status:
-                                if st.button("Update Status", key=f"update_{student['id']}"):
-                                    update_payment_status(student.get("id"), new_status)
-                                    st.success("Status updated!")
-                                    st.rerun()
-                        
-                        # Update payment account used
-                        payment_accounts = get_payment_accounts()
-                        if payment_accounts:
-                            current_account = student.get("payment_account_used", "")
-                            account_options = [f"{acc.get('bank')} - {acc.get('account')} - {acc.get('name')}" for acc in payment_accounts]
-                            
-                            if current_account not in account_options and current_account:
-                                account_options.insert(0, current_account)
-                            
-                            new_account = st.selectbox(
-                                "Update Payment Account Used",
-                                options=account_options,
-                                index=account_options.index(current_account) if current_account in account_options else 0,
-                                key=f"account_{student['id']}"
-                            )
-                            
-                            if new_account != current_account:
-                                if st.button("Update Account", key=f"update_acc_{student['id']}"):
-                                    student["payment_account_used"] = new_account
-                                    save_students(students)
-                                    
-                                    # Update payment record if exists
-                                    payments = get_payments()
-                                    for payment in payments:
-                                        if payment.get("student_id") == student.get("id"):
-                                            payment["payment_account"] = new_account
-                                            break
-                                    save_payments(payments)
-                                    
-                                    st.success("Payment account updated!")
-                                    st.rerun()
-                        
-                        # Admin remarks
-                        admin_remarks = st.text_area(
-                            "Admin Remarks",
-                            value=student.get("admin_remarks", ""),
-                            key=f"remarks_{student['id']}",
-                            height=100
-                        )
-                        if admin_remarks != student.get("admin_remarks", ""):
-                            if st.button("Save Remarks", key=f"save_remarks_{student['id']}"):
-                                student["admin_remarks"] = admin_remarks
-                                save_students(students)
-                                st.success("Remarks updated!")
-                                st.rerun()
-                        
-                        # Delete student button
-                        if st.button("Delete Student", key=f"delete_{student['id']}", type="secondary"):
-                            # Remove student from students list
-                            updated_students = [s for s in students if s.get("id") != student.get("id")]
-                            save_students(updated_students)
-                            
-                            # Remove student's payments
-                            payments = get_payments()
-                            updated_payments = [p for p in payments if p.get("student_id") != student.get("id")]
-                            save_payments(updated_payments)
-                            
-                            # Delete uploaded files if any
-                            student_payments = get_student_payments(student.get("id"))
-                            for payment in student_payments:
-                                if payment.get("screenshot"):
-                                    delete_screenshot_file(payment.get("screenshot"))
-                            
-                            st.success("Student deleted successfully!")
-                            st.rerun()
+                        show_student_actions(student["id"])
             else:
                 st.info("No students found matching your criteria")
         else:
@@ -1595,32 +3352,52 @@ def show_student_management():
                 bulk_search = st.text_input("Search by Name or Roll Number", key="bulk_search")
             
             # Apply filters
-            filtered_students = students
-            if bulk_filter_status != "All":
-                filtered_students = [s for s in filtered_students if s.get("payment_status") == bulk_filter_status]
-            
-            if bulk_search:
-                filtered_students = [s for s in filtered_students 
-                                   if bulk_search.lower() in s.get("name", "").lower() 
-                                   or bulk_search in s.get("roll_number", "")]
+            filtered_students = filter_records("students", status=bulk_filter_status, search=bulk_search)
             
             if filtered_students:
                 # Create a DataFrame for display with checkboxes
                 st.info(f"Found {len(filtered_students)} students matching your criteria")
                 
-                # Create checkboxes for each student
-                selected_students = []
+                # Selections live outside the checkboxes so they survive paging
+                selection = st.session_state.setdefault("bulk_delete_selection", set())
+                
+                def toggle_selection(student_id):
+                    if st.session_state[f"select_{student_id}"]:
+                        selection.add(student_id)
+                    else:
+                        selection.discard(student_id)
+                
+                page_students = paginate(filtered_students, "bulk_delete", default_page_size=50)
+                
+                col1, col2 = st.columns(2)
+                with col1:
+                    if st.button("Select All on This Page"):
+                        for student in page_students:
+                            selection.add(student["id"])
+                            st.session_state[f"select_{student['id']}"] = True
+                with col2:
+                    if st.button("Select All Matching"):
+                        for student in filtered_students:
+                            selection.add(student["id"])
+                        for student in page_students:
+                            st.session_state[f"select_{student['id']}"] = True
                 
-                # Display in groups of 10 for better performance
-                for i in range(0, len(filtered_students), 10):
-                    group = filtered_students[i:i+10]
+                # Checkboxes for the current page only
+                for i in range(0, len(page_students), 10):
+                    group = page_students[i:i+10]
                     
                     for student in group:
                         col1, col2, col3, col4 = st.columns([1, 3, 3, 2])
                         with col1:
-                            selected = st.checkbox("", key=f"select_{student['id']}")
-                            if selected:
-                                selected_students.append(student["id"])
+                            # Checkbox state is dropped while off-page, so restore it from the selection
+                            st.session_state.setdefault(f"select_{student['id']}", student["id"] in selection)
+                            st.checkbox(
+                                "Select",
+                                key=f"select_{student['id']}",
+                                on_change=toggle_selection,
+                                args=(student["id"],),
+                                label_visibility="collapsed"
+                            )
                         with col2:
                             st.write(f"**{student.get('name')}**")
                         with col3:
@@ -1632,7 +3409,8 @@ def show_student_management():
                     
                     st.divider()
                 
-                # Summary of selected students
+                # Summary of selected students, across all pages
+                selected_students = [student_id for student_id in selection if get_student_by_id(student_id)]
                 if selected_students:
                     st.subheader(f"Selected {len(selected_students)} Students for Deletion")
                     
@@ -1669,13 +3447,18 @@ def show_student_management():
                         if st.button("🗑️ Delete Selected Students", type="secondary", disabled=confirm_text != "DELETE"):
                             if confirm_text == "DELETE":
                                 with st.spinner("Deleting selected students..."):
-                                    success_count, fail_count = delete_multiple_students(selected_students)
+                                    results, failed_files = delete_multiple_students(selected_students)
+                                    show_file_delete_failures(failed_files)
+                                    success_count = list(results.values()).count("deleted")
+                                    not_found = [student_id for student_id, result in results.items() if result != "deleted"]
                                     
+                                    selection.clear()
                                     if success_count > 0:
                                         st.success(f"Successfully deleted {success_count} students!")
-                                        if fail_count > 0:
-                                            st.warning(f"Failed to delete {fail_count} students")
-                                        st.rerun()
+                                        if not_found:
+                                            st.warning(f"Failed to delete {len(not_found)} students (already removed)")
+                                        if not failed_files:
+                                            st.rerun()
                                     else:
                                         st.error("Failed to delete any students")
                             else:
@@ -1683,6 +3466,9 @@ def show_student_management():
                     
                     with col2:
                         if st.button("Clear Selection"):
+                            selection.clear()
+                            for student in page_students:
+                                st.session_state.pop(f"select_{student['id']}", None)
                             st.rerun()
                 else:
                     st.info("Select students by checking the boxes to enable deletion")
@@ -1691,14 +3477,243 @@ def show_student_management():
         else:
             st.info("No students found to delete")
 
+@fragment
+def show_student_actions(student_id):
+    """Details and actions for one student; its buttons rerun only this panel"""
+    student = get_student_by_id(student_id)
+    if student is None:
+        st.info("Student has been deleted")
+        return
+    
+    col1, col2, col3, col4 = st.columns([2, 2, 2, 2])
+    
+    with col1:
+        st.write(f"**Name:** {student.get('name')}")
+    with col2:
+        st.write(f"**Roll Number:** {student.get('roll_number')}")
+    with col3:
+        added_by = "Admin" if student.get("added_by_admin") else "Student"
+        st.write(f"**Added By:** {added_by}")
+    with col4:
+        status = student.get("payment_status", "Pending")
+        color = {"Paid": "green", "Unpaid": "red", "Pending": "orange"}.get(status, "gray")
+        st.markdown(f"**Status:** <span style='color:{color}'>{status}</span>", 
+                  unsafe_allow_html=True)
+    
+    # Show payment date and time
+    if student.get("payment_datetime"):
+        formatted_datetime = format_datetime(student.get("payment_datetime"))
+        timestamp_type = "Auto-generated (Student submission)" if student.get("auto_timestamp") else "Manually set by Admin"
+        st.info(f"**Payment Date & Time:** {formatted_datetime}")
+        st.info(f"**Timestamp Type:** {timestamp_type}")
+    
+    # Show payment account used
+    if student.get("payment_account_used"):
+        st.info(f"**Payment Account Used:** {student.get('payment_account_used')}")
+    
+    # Check if screenshot was deleted
+    if student.get("screenshot_deleted"):
+        st.warning("⚠️ Payment screenshot has been deleted")
+    
+    # Show payment history with screenshot management
+    st.subheader("Payment History & Screenshot Management")
+    payments = get_student_payments(student.get("id"))
+    if payments:
+        for payment in payments:
+            with st.expander(f"Payment: {payment.get('transaction_id')} - {payment.get('status')}"):
+                col_info1, col_info2 = st.columns(2)
+                with col_info1:
+                    st.write(f"**Amount:** PKR {payment.get('amount')}")
+                    st.write(f"**Date:** {format_datetime(payment.get('payment_datetime'))}")
+                with col_info2:
+                    st.write(f"**Account:** {payment.get('payment_account')}")
+                    st.write(f"**Status:** {payment.get('status')}")
+                
+                # Screenshot section
+                st.write("**Screenshot:**")
+                screenshot_settings = get_screenshot_settings()
+                
+                if payment.get("screenshot_deleted"):
+                    st.warning("🗑️ Screenshot has been deleted")
+                elif payment.get("screenshot"):
+                    col_ss1, col_ss2, col_ss3 = st.columns(3)
+                    
+                    with col_ss1:
+                        # View button
+                        screenshot_stored = screenshot_exists(payment.get("screenshot"))
+                        if screenshot_stored:
+                            show_screenshot_preview(payment, key=f"view_payment_{payment['id']}", use_container_width=True)
+                        else:
+                            st.warning("File not found")
+                    
+                    with col_ss2:
+                        # Download button
+                        if screenshot_stored:
+                            if screenshot_settings.get("allow_download", True):
+                                show_screenshot_download(
+                                    payment,
+                                    key=f"download_payment_{payment['id']}",
+                                    use_container_width=True
+                                )
+                            else:
+                                st.warning("Download disabled")
+                        else:
+                            st.warning("File not found")
+                    
+                    with col_ss3:
+                        # Delete button
+                        if screenshot_settings.get("allow_delete", True):
+                            if st.button("🗑️ Delete", key=f"delete_payment_{payment['id']}", type="secondary", use_container_width=True):
+                                if delete_payment_screenshots(payment, {payment.get("id")}):
+                                    remove_screenshot_from_payment(payment.get("id"))
+                                    remove_screenshot_from_student(payment.get("student_id"))
+                                    st.success("Screenshot deleted successfully!")
+                                    rerun_fragment()
+                                else:
+                                    st.error("Failed to delete screenshot")
+                        else:
+                            st.warning("Delete disabled")
+                else:
+                    show_missing_screenshot(payment, "No screenshot uploaded")
+                
+                # Quick status update
+                col_status1, col_status2 = st.columns(2)
+                with col_status1:
+                    if payment.get("status") != "Paid":
+                        if st.button("✅ Mark as Paid", key=f"paid_{payment['id']}", use_container_width=True):
+                            commit_operations([
+                                {"op": "update", "table": "payments", "id": payment["id"], "fields": {"status": "Paid"}},
+                                {"op": "update", "table": "students", "id": student["id"], "fields": {"payment_status": "Paid"}}
+                            ])
+                            st.success("Payment marked as Paid!")
+                            rerun_fragment()
+                with col_status2:
+                    if payment.get("status") != "Unpaid":
+                        if st.button("❌ Mark as Unpaid", key=f"unpaid_{payment['id']}", use_container_width=True):
+                            commit_operations([
+                                {"op": "update", "table": "payments", "id": payment["id"], "fields": {"status": "Unpaid"}},
+                                {"op": "update", "table": "students", "id": student["id"], "fields": {"payment_status": "Unpaid"}}
+                            ])
+                            st.success("Payment marked as Unpaid!")
+                            rerun_fragment()
+    
+    # Update payment date and time (Admin can modify)
+    st.subheader("Update Payment Date & Time")
+    st.warning("Admin can modify the payment timestamp if needed")
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        if student.get("payment_datetime"):
+            current_dt = datetime.fromisoformat(student.get("payment_datetime"))
+        else:
+            current_dt = datetime.now()
+        
+        new_payment_date = st.date_input(
+            "New Payment Date",
+            value=current_dt.date(),
+            key=f"date_{student['id']}"
+        )
+    with col2:
+        new_payment_time = st.time_input(
+            "New Payment Time",
+            value=current_dt.time(),
+            key=f"time_{student['id']}"
+        )
+    
+    new_payment_datetime = datetime.combine(new_payment_date, new_payment_time)
+    
+    if new_payment_datetime.isoformat() != student.get("payment_datetime"):
+        if st.button("Update Payment Date/Time", key=f"update_dt_{student['id']}"):
+            # Mark as manually set by admin
+            new_fields = {"payment_datetime": new_payment_datetime.isoformat(), "auto_timestamp": False}
+            ops = [{"op": "update", "table": "students", "id": student["id"], "fields": new_fields}]
+            
+            # Update payment record if exists
+            student_payments = get_student_payments(student["id"])
+            if student_payments:
+                ops.append({"op": "update", "table": "payments", "id": student_payments[0]["id"], "fields": new_fields})
+            commit_operations(ops)
+            st.success("Payment date/time updated!")
+            rerun_fragment()
+    
+    # Status update section
+    st.subheader("Update Payment Status")
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        # Status update dropdown
+        new_status = st.selectbox(
+            "Update Status",
+            ["Paid", "Unpaid", "Pending"],
+            index=["Paid", "Unpaid", "Pending"].index(status),
+            key=f"status_{student['id']}"
+        )
+    with col2:
+        st.write("")  # Spacer
+        if new_status != status:
+            if st.button("Update Status", key=f"update_{student['id']}"):
+                update_payment_status(student.get("id"), new_status)
+                st.success("Status updated!")
+                rerun_fragment()
+    
+    # Update payment account used
+    payment_accounts = get_payment_accounts()
+    if payment_accounts:
+        current_account = student.get("payment_account_used", "")
+        account_options = [f"{acc.get('bank')} - {acc.get('account')} - {acc.get('name')}" for acc in payment_accounts]
+        
+        if current_account not in account_options and current_account:
+            account_options.insert(0, current_account)
+        
+        new_account = st.selectbox(
+            "Update Payment Account Used",
+            options=account_options,
+            index=account_options.index(current_account) if current_account in account_options else 0,
+            key=f"account_{student['id']}"
+        )
+        
+        if new_account != current_account:
+            if st.button("Update Account", key=f"update_acc_{student['id']}"):
+                ops = [{"op": "update", "table": "students", "id": student["id"], "fields": {"payment_account_used": new_account}}]
+                
+                # Update payment record if exists
+                student_payments = get_student_payments(student["id"])
+                if student_payments:
+                    ops.append({"op": "update", "table": "payments", "id": student_payments[0]["id"], "fields": {"payment_account": new_account}})
+                commit_operations(ops)
+                
+                st.success("Payment account updated!")
+                rerun_fragment()
+    
+    # Admin remarks
+    admin_remarks = st.text_area(
+        "Admin Remarks",
+        value=student.get("admin_remarks", ""),
+        key=f"remarks_{student['id']}",
+        height=100
+    )
+    if admin_remarks != student.get("admin_remarks", ""):
+        if st.button("Save Remarks", key=f"save_remarks_{student['id']}"):
+            update_student_fields(student["id"], {"admin_remarks": admin_remarks})
+            st.success("Remarks updated!")
+            rerun_fragment()
+    
+    # Delete student button
+    if st.button("Delete Student", key=f"delete_{student['id']}", type="secondary"):
+        # Removes the student, their payments and uploaded files
+        _, failed_files = delete_multiple_students([student.get("id")])
+        
+        st.success("Student deleted successfully!")
+        if failed_files:
+            show_file_delete_failures(failed_files)
+        else:
+            rerun_fragment()
+
 def add_student_with_details(name, roll_number, payment_status, selected_account, 
                             transaction_id, amount_paid, admin_remarks, 
                             payment_datetime, submitted_by):
     """Helper function to add student with all details"""
-    students = get_students()
-    
     # Check for duplicate roll number
-    if any(s.get("roll_number") == roll_number for s in students):
+    if get_student_by_roll(roll_number):
         st.error("Roll number already exists")
         return
     
@@ -1718,8 +3733,7 @@ def add_student_with_details(name, roll_number, payment_status, selected_account
         "screenshot_deleted": False
     }
     
-    students.append(student_data)
-    save_students(students)
+    ops = [{"op": "insert", "table": "students", "record": student_data, "unique": ["roll_number"]}]
     
     # If student is marked as paid, also create a payment record
     if payment_status == "Paid" and amount_paid > 0:
@@ -1741,9 +3755,13 @@ def add_student_with_details(name, roll_number, payment_status, selected_account
             "verified_by_admin": True
         }
         
-        payments = get_payments()
-        payments.append(payment_data)
-        save_payments(payments)
+        ops.append({"op": "insert", "table": "payments", "record": payment_data})
+    
+    try:
+        commit_operations(ops)
+    except DuplicateRecordError:
+        st.error("Roll number already exists")
+        return
     
     st.success("Student added successfully!")
     st.balloons()
@@ -2143,11 +4161,47 @@ def show_screenshot_management():
                     help="Maximum allowed file size for uploaded screenshots"
                 )
             
+            st.markdown("**Compression**")
+            col1, col2 = st.columns(2)
+            
+            with col1:
+                compress_enabled = st.checkbox(
+                    "Compress Uploaded Screenshots",
+                    value=screenshot_settings.get("compress_enabled", False),
+                    help="Re-encode screenshots as JPEG in the background after submission"
+                )
+                
+                keep_original = st.checkbox(
+                    "Keep Original Upload",
+                    value=screenshot_settings.get("keep_original", True),
+                    help="Keep the uploaded file next to the compressed copy"
+                )
+            
+            with col2:
+                compress_quality = st.slider(
+                    "JPEG Quality",
+                    min_value=30,
+                    max_value=95,
+                    value=screenshot_settings.get("compress_quality", 75)
+                )
+                
+                compress_max_dimension = st.number_input(
+                    "Maximum Width/Height (px)",
+                    min_value=400,
+                    max_value=6000,
+                    value=screenshot_settings.get("compress_max_dimension", 1600),
+                    step=100
+                )
+            
             if st.form_submit_button("💾 Save Settings"):
                 new_settings = {
                     "allow_download": allow_download,
                     "allow_delete": allow_delete,
-                    "max_file_size_mb": max_file_size
+                    "max_file_size_mb": max_file_size,
+                    "compress_enabled": compress_enabled,
+                    "compress_quality": compress_quality,
+                    "compress_max_dimension": compress_max_dimension,
+                    "keep_original": keep_original
                 }
                 update_screenshot_settings(new_settings)
                 st.success("Screenshot settings saved!")
@@ -2169,6 +4223,51 @@ def show_screenshot_management():
             st.metric("Active Screenshots", active_screenshots)
         with col3:
             st.metric("Deleted Screenshots", deleted_screenshots)
+        
+        # Screenshots that were submitted for more than one payment
+        reused = [ids for ids in get_index().screenshot_payments.values() if len(ids) > 1]
+        col1, col2 = st.columns(2)
+        with col1:
+            st.metric("Reused Screenshots", len(reused))
+        with col2:
+            if st.button("🔁 Hash Existing Screenshots", help="Index screenshots uploaded before duplicate detection"):
+                count = backfill_screenshot_hashes()
+                st.success(f"Hashed {count} screenshot(s)")
+        
+        # Files uploaded before the sharded layout live directly in UPLOADS_DIR
+        if st.button("📦 Move Old Uploads Into Subfolders", help="Safe to run while students are submitting"):
+            moved = migrate_uploads_to_shards()
+            st.success(f"Moved {moved} file(s)")
+        
+        # Screenshots uploaded before compression was enabled
+        if st.button("🗜️ Compress Existing Screenshots", disabled=not screenshot_settings.get("compress_enabled")):
+            queued = [f for f in (schedule_compression(p, screenshot_settings) for p in get_payments()) if f]
+            st.success(f"Queued {len(queued)} screenshot(s) for compression")
+        
+        # Old screenshots are packed into archive files but stay viewable
+        archive_days = st.number_input("Archive screenshots older than (days)", min_value=1, value=180, step=30)
+        if st.button("🗄️ Archive Old Screenshots"):
+            count, total = archive_old_screenshots(archive_days)
+            st.success(f"Archived {count} file(s) ({total / (1024 * 1024):.2f} MB)")
+        
+        # Files without payments and payments without files
+        st.divider()
+        st.subheader("Storage Cleanup")
+        delete_orphans = st.checkbox("Delete orphaned files", key="gc_delete_orphans")
+        repair_dangling = st.checkbox("Clear references to missing files", key="gc_repair_dangling")
+        if st.button("🧹 Scan Screenshot Storage"):
+            report = collect_screenshot_garbage(delete_orphans=delete_orphans, repair_dangling=repair_dangling)
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("Orphaned Files", len(report["orphans"]))
+            with col2:
+                st.metric("Reclaimable Space", f"{report['reclaimable_bytes'] / (1024 * 1024):.2f} MB")
+            with col3:
+                st.metric("Missing Files", len(report["dangling"]))
+            if delete_orphans:
+                st.success(f"Deleted {report['deleted']} orphaned file(s)")
+            if repair_dangling:
+                st.success(f"Repaired {report['repaired']} payment(s)")
     
     with tab2:
         st.subheader("Bulk Screenshot Operations")
@@ -2185,30 +4284,12 @@ def show_screenshot_management():
                 bulk_filter_date = st.selectbox("Filter by Date", ["All", "Today", "Last 7 Days", "This Month"])
             
             # Apply filters
-            filtered_payments = payments
-            if bulk_filter_status != "All":
-                filtered_payments = [p for p in filtered_payments if p.get("status") == bulk_filter_status]
-            
-            if bulk_filter_date != "All":
-                today = datetime.now().date()
-                filtered_by_date = []
-                for payment in filtered_payments:
-                    payment_datetime = payment.get("payment_datetime")
-                    if payment_datetime:
-                        try:
-                            payment_date = datetime.fromisoformat(payment_datetime).date()
-                            if bulk_filter_date == "Today" and payment_date == today:
-                                filtered_by_date.append(payment)
-                            elif bulk_filter_date == "Last 7 Days" and (today - payment_date).days <= 7:
-                                filtered_by_date.append(payment)
-                            elif bulk_filter_date == "This Month" and payment_date.month == today.month and payment_date.year == today.year:
-                                filtered_by_date.append(payment)
-                        except:
-                            pass
-                filtered_payments = filtered_by_date
-            
-            # Count screenshots in filtered results
-            screenshots_to_process = [p for p in filtered_payments if p.get("screenshot") and not p.get("screenshot_deleted")]
+            screenshots_to_process = filter_records(
+                "payments",
+                status=bulk_filter_status,
+                date_range=bulk_filter_date,
+                has_screenshot=True
+            )
             
             st.info(f"Found {len(screenshots_to_process)} screenshots matching your criteria")
             
@@ -2217,15 +4298,13 @@ def show_screenshot_management():
                 st.subheader("Bulk Delete Screenshots")
                 if st.button("🗑️ Delete All Filtered Screenshots", type="secondary"):
                     with st.spinner("Deleting screenshots..."):
-                        deleted_count = 0
-                        for payment in screenshots_to_process:
-                            if delete_screenshot_file(payment.get("screenshot")):
-                                remove_screenshot_from_payment(payment.get("id"))
-                                remove_screenshot_from_student(payment.get("student_id"))
-                                deleted_count += 1
+                        deleted_count, failed_files = delete_screenshots(screenshots_to_process)
                         
-                        st.success(f"Successfully deleted {deleted_count} screenshots!")
-                        st.rerun()
+                        if failed_files:
+                            show_file_delete_failures(failed_files)
+                        else:
+                            st.success(f"Successfully deleted {deleted_count} screenshots!")
+                            st.rerun()
                 
                 # View filtered payments
                 st.subheader("Filtered Payments with Screenshots")
@@ -2235,17 +4314,12 @@ def show_screenshot_management():
                         with st.expander(f"{student.get('name')} - {payment.get('transaction_id')}"):
                             col_view, col_del = st.columns(2)
                             with col_view:
-                                if st.button("👁️ View", key=f"bulk_view_{payment['id']}"):
-                                    screenshot_path = UPLOADS_DIR / payment.get("screenshot")
-                                    if screenshot_path.exists():
-                                        with open(screenshot_path, "rb") as f:
-                                            img_bytes = f.read()
-                                        st.image(img_bytes, caption="Payment Screenshot", use_column_width=True)
+                                show_screenshot_preview(payment, key=f"bulk_view_{payment['id']}")
                             with col_del:
                                 if st.button("🗑️ Delete", key=f"bulk_delete_{payment['id']}", type="secondary"):
-                                    if delete_screenshot_file(payment.get("screenshot")):
-                                        remove_screenshot_from_payment(payment.get("id"))
-                                        remove_screenshot_from_student(payment.get("student_id"))
+                                    deleted_count, failed_files = delete_screenshots([payment])
+                                    show_file_delete_failures(failed_files)
+                                    if deleted_count and not failed_files:
                                         st.success("Screenshot deleted!")
                                         st.rerun()
     
@@ -2277,6 +4351,20 @@ def show_screenshot_management():
             with col5:
                 st.metric("Deleted Screenshots", deleted_screenshots)
             
+            # Uploads still being stored in the background
+            queue = get_screenshot_queue()
+            col6, col7, col8 = st.columns(3)
+            with col6:
+                st.metric("Processing", len([p for p in payments if p.get("screenshot_status") == "processing"]))
+            with col7:
+                st.metric("Failed Uploads", len([p for p in payments if p.get("screenshot_status") == "failed"]))
+            with col8:
+                st.metric(
+                    "Background Jobs",
+                    queue["queued"] + queue["running"],
+                    help=f"{queue['done']} completed and {queue['failed']} failed since the server started"
+                )
+            
             # Simple visualization using Streamlit's built-in chart
             st.divider()
             st.subheader("Screenshot Distribution")
@@ -2318,6 +4406,240 @@ def show_screenshot_management():
                         with col_date:
                             st.write(format_datetime(payment.get("submission_date")))
                         st.divider()
+            
+            # Near-duplicate screenshots across all payments
+            st.subheader("Similar Screenshots")
+            radius = st.slider("Maximum difference (bits)", 0, 16, NEAR_DUPLICATE_DISTANCE, key="similar_radius")
+            if st.button("🔍 Find Similar Screenshots"):
+                def describe(content_hash):
+                    rolls = []
+                    for other in get_payments_by_screenshot_hash(content_hash):
+                        other_student = get_student_by_id(other.get("student_id"))
+                        rolls.append(other_student.get("roll_number") if other_student else "Unknown")
+                    return ", ".join(rolls)
+                
+                pairs = find_near_duplicate_groups(radius)
+                if pairs:
+                    st.dataframe(pd.DataFrame([
+                        {"Roll Numbers": describe(first), "Similar To": describe(second), "Difference (bits)": distance}
+                        for distance, first, second in pairs
+                    ]), use_container_width=True, hide_index=True)
+                else:
+                    st.success("No similar screenshots found")
+
+# Report exports
+# Exports covering more rows than this are built on a background thread
+EXPORT_BACKGROUND_ROWS = 2000
+# Screenshot reads kept in flight while writing the ZIP export
+ZIP_READ_WORKERS = 8
+# Image formats that are already compressed and are stored in ZIPs as-is
+PRECOMPRESSED_EXTENSIONS = {".png", ".jpg", ".jpeg"}
+EXPORT_MIME_TYPES = {
+    "CSV": "text/csv",
+    "Excel": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "ZIP": "application/zip"
+}
+
+@st.cache_resource
+def get_export_jobs():
+    """Latest export job per (name, filter, format), shared by every admin session"""
+    # Spooled files from a previous run of the app are no longer referenced
+    if EXPORTS_DIR.exists():
+        for leftover in EXPORTS_DIR.iterdir():
+            if time.time() - leftover.stat().st_mtime > 24 * 60 * 60:
+                leftover.unlink(missing_ok=True)
+    return {"jobs": {}, "lock": threading.Lock(), "executor": ThreadPoolExecutor(max_workers=2)}
+
+def run_export_job(job, builder):
+    exports = get_export_jobs()
+    data = None
+    try:
+        data = builder(job)
+        status = "done"
+    except Exception as e:
+        job["error"] = str(e)
+        status = "failed"
+    with exports["lock"]:
+        job["data"] = data
+        job["status"] = status
+        job["progress"] = 1.0
+        evicted = job["evicted"]
+    # Replaced by a newer export while running; nothing will serve this file
+    if evicted and isinstance(data, Path):
+        data.unlink(missing_ok=True)
+
+def start_export(name, export_format, filter_value, row_count, builder):
+    """Build an export unless one for the current data is already cached
+
+    builder(job) returns the file contents and may update job["progress"].
+    """
+    exports = get_export_jobs()
+    key = (name, filter_value, export_format)
+    version = get_data_version()
+    with exports["lock"]:
+        job = exports["jobs"].get(key)
+        if job and job["version"] == version and job["status"] != "failed":
+            return job
+        # The previous export is replaced; a spooled file is deleted once unused
+        if job:
+            if job["status"] == "running":
+                job["evicted"] = True
+            elif isinstance(job["data"], Path):
+                job["data"].unlink(missing_ok=True)
+        job = {
+            "status": "running", "progress": 0.0, "data": None, "error": None,
+            "version": version, "prepared_at": datetime.now(), "evicted": False
+        }
+        exports["jobs"][key] = job
+    if row_count > EXPORT_BACKGROUND_ROWS:
+        exports["executor"].submit(run_export_job, job, builder)
+    else:
+        run_export_job(job, builder)
+    return job
+
+def get_export(name, export_format, filter_value):
+    exports = get_export_jobs()
+    return exports["jobs"].get((name, filter_value, export_format))
+
+def show_export_download(job, label, file_name, mime, key):
+    """Show progress, an error, or the download button for an export job"""
+    if job is None:
+        return
+    if job["version"] != get_data_version() and job["status"] != "failed":
+        st.info(
+            f"Data has changed since this export was prepared at {job['prepared_at'].strftime('%I:%M %p')}. "
+            "Prepare it again to include the latest changes."
+        )
+    if job["status"] == "running":
+        st.progress(job["progress"], text="Preparing export...")
+        st.button("🔄 Check Progress", key=f"{key}_progress")
+    elif job["status"] == "failed":
+        st.error(f"Export failed: {job['error']}")
+    elif isinstance(job["data"], Path):
+        # Spooled to disk; only read when the download button is clicked
+        if job["data"].exists():
+            st.download_button(label, job["data"].read_bytes, file_name=file_name, mime=mime, key=key, use_container_width=True)
+        else:
+            st.warning("This export has expired, please prepare it again")
+    else:
+        st.download_button(label, job["data"], file_name=file_name, mime=mime, key=key, use_container_width=True)
+
+def dataframe_to_export(df, export_format, sheet_name):
+    if export_format == "CSV":
+        return df.to_csv(index=False)
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        df.to_excel(writer, index=False, sheet_name=sheet_name)
+    return output.getvalue()
+
+def build_student_export(students, payments, export_format, job):
+    # One pass over payments instead of a lookup per student row
+    students_with_screenshots = {p.get("student_id") for p in payments if p.get("screenshot")}
+    
+    payment_dates = format_record_datetimes(students, "payment_datetime")
+    registration_dates = format_record_datetimes(students, "registration_date")
+    
+    rows = []
+    for i, s in enumerate(students):
+        rows.append({
+            "Name": s.get("name"),
+            "Roll Number": s.get("roll_number"),
+            "Payment Status": s.get("payment_status"),
+            "Payment Date": payment_dates[i],
+            "Timestamp Type": "Auto" if s.get("auto_timestamp") else "Manual",
+            "Screenshot Status": "Deleted" if s.get("screenshot_deleted") else ("Available" if s.get("id") in students_with_screenshots else "Not Available"),
+            "Payment Account Used": s.get("payment_account_used", ""),
+            "Admin Remarks": s.get("admin_remarks", ""),
+            "Student Remarks": s.get("student_remarks", ""),
+            "Added By": "Admin" if s.get("added_by_admin") else "Student",
+            "Registration Date": registration_dates[i]
+        })
+        if i % 500 == 0:
+            job["progress"] = 0.8 * i / len(students)
+    
+    return dataframe_to_export(pd.DataFrame(rows), export_format, "Students")
+
+def build_payment_export(payments, students, export_format, job):
+    students_by_id = {s.get("id"): s for s in students}
+    payment_dates = format_record_datetimes(payments, "payment_datetime")
+    submission_dates = format_record_datetimes(payments, "submission_date")
+    
+    rows = []
+    for i, payment in enumerate(payments):
+        student = students_by_id.get(payment.get("student_id"))
+        if student:
+            rows.append({
+                "Student Name": student.get("name"),
+                "Roll Number": student.get("roll_number"),
+                "Transaction ID": payment.get("transaction_id"),
+                "Amount": payment.get("amount"),
+                "Status": payment.get("status"),
+                "Payment Date": payment_dates[i],
+                "Timestamp Type": "Auto" if payment.get("auto_timestamp") else "Manual",
+                "Screenshot Status": "Deleted" if payment.get("screenshot_deleted") else ("Available" if payment.get("screenshot") else {"processing": "Processing", "failed": "Failed"}.get(payment.get("screenshot_status"), "Not Available")),
+                "Form Submission Date": submission_dates[i],
+                "Payment Account": payment.get("payment_account", ""),
+                "Submitted By": "Admin" if payment.get("added_by_admin") else "Student",
+                "Admin Remarks": payment.get("admin_remarks", ""),
+                "Student Remarks": payment.get("student_remarks", "")
+            })
+        if i % 500 == 0:
+            job["progress"] = 0.8 * i / len(payments)
+    
+    if not rows:
+        raise ValueError("No payment data to export")
+    return dataframe_to_export(pd.DataFrame(rows), export_format, "Payments")
+
+def zip_date_time(payment):
+    try:
+        return datetime.fromisoformat(payment.get("submission_date")).timetuple()[:6]
+    except:
+        return datetime.now().timetuple()[:6]
+
+def build_screenshot_zip(payments, students, job):
+    """Write the screenshots into a ZIP spooled to disk and return its path
+
+    Files are read by a small thread pool with a bounded number in flight,
+    and JPEG/PNG data is stored as-is since deflating it gains nothing.
+    """
+    students_by_id = {s.get("id"): s for s in students}
+    entries = []
+    for payment in payments:
+        # Get student info for better file naming
+        student = students_by_id.get(payment.get("student_id"))
+        if student:
+            new_name = f"{student.get('roll_number')}_{student.get('name')}_{payment.get('transaction_id')}_{payment.get('screenshot')}"
+            entries.append((payment, new_name))
+    
+    EXPORTS_DIR.mkdir(exist_ok=True)
+    fd, zip_path = tempfile.mkstemp(prefix="screenshots_", suffix=".zip", dir=EXPORTS_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as f, zipfile.ZipFile(f, 'w') as zip_file, \
+                ThreadPoolExecutor(max_workers=ZIP_READ_WORKERS) as pool:
+            def write_entry(payment, name, future):
+                img_bytes = future.result()
+                if img_bytes is None:
+                    return
+                info = zipfile.ZipInfo(name, date_time=zip_date_time(payment))
+                if Path(name).suffix.lower() in PRECOMPRESSED_EXTENSIONS:
+                    info.compress_type = zipfile.ZIP_STORED
+                else:
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                zip_file.writestr(info, img_bytes)
+            
+            pending = deque()
+            for i, (payment, name) in enumerate(entries):
+                pending.append((payment, name, pool.submit(view_screenshot, payment.get("screenshot"))))
+                if len(pending) >= ZIP_READ_WORKERS * 2:
+                    write_entry(*pending.popleft())
+                job["progress"] = i / len(entries)
+            while pending:
+                write_entry(*pending.popleft())
+    except:
+        os.unlink(zip_path)
+        raise
+    
+    return Path(zip_path)
 
 def show_reports():
     st.title("📈 Reports & Exports")
@@ -2338,51 +4660,24 @@ def show_reports():
         
         if students:
             # Filter students
-            filtered_students = students
-            if filter_status != "All":
-                filtered_students = [s for s in students if s.get("payment_status") == filter_status]
-            
-            # Convert to DataFrame with payment date
-            df = pd.DataFrame([
-                {
-                    "Name": s.get("name"),
-                    "Roll Number": s.get("roll_number"),
-                    "Payment Status": s.get("payment_status"),
-                    "Payment Date": format_datetime(s.get("payment_datetime", "")),
-                    "Timestamp Type": "Auto" if s.get("auto_timestamp") else "Manual",
-                    "Screenshot Status": "Deleted" if s.get("screenshot_deleted") else ("Available" if any(p.get("screenshot") for p in get_student_payments(s.get("id"))) else "Not Available"),
-                    "Payment Account Used": s.get("payment_account_used", ""),
-                    "Admin Remarks": s.get("admin_remarks", ""),
-                    "Student Remarks": s.get("student_remarks", ""),
-                    "Added By": "Admin" if s.get("added_by_admin") else "Student",
-                    "Registration Date": format_datetime(s.get("registration_date", ""))
-                }
-                for s in filtered_students
-            ])
-            
-            if not df.empty:
-                if export_format == "CSV":
-                    csv = df.to_csv(index=False)
-                    st.download_button(
-                        "Download CSV",
-                        csv,
-                        file_name=f"students_{filter_status.lower()}_{datetime.now().strftime('%Y%m%d')}.csv",
-                        mime="text/csv",
-                        use_container_width=True
-                    )
-                else:
-                    output = io.BytesIO()
-                    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                        df.to_excel(writer, index=False, sheet_name='Students')
-                    excel_data = output.getvalue()
-                    
-                    st.download_button(
-                        "Download Excel",
-                        excel_data,
-                        file_name=f"students_{filter_status.lower()}_{datetime.now().strftime('%Y%m%d')}.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        use_container_width=True
+            filtered_students = filter_records("students", status=filter_status)
+            
+            if filtered_students:
+                # Exports are only built on request and reused until the data changes
+                if st.button("Prepare Student Export", use_container_width=True):
+                    start_export(
+                        "students", export_format, filter_status, len(filtered_students),
+                        lambda job: build_student_export(filtered_students, payments, export_format, job)
                     )
+                
+                extension = "csv" if export_format == "CSV" else "xlsx"
+                show_export_download(
+                    get_export("students", export_format, filter_status),
+                    f"Download {export_format}",
+                    f"students_{filter_status.lower()}_{datetime.now().strftime('%Y%m%d')}.{extension}",
+                    EXPORT_MIME_TYPES[export_format],
+                    "student_export_download"
+                )
             else:
                 st.info("No data to export for selected filter")
         else:
@@ -2399,56 +4694,23 @@ def show_reports():
         
         if payments:
             # Filter payments
-            filtered_payments = payments
-            if payment_filter != "All":
-                filtered_payments = [p for p in payments if p.get("status") == payment_filter]
+            filtered_payments = filter_records("payments", status=payment_filter)
             
-            # Get student info for each payment
-            payment_data = []
-            for payment in filtered_payments:
-                student = get_student_by_id(payment.get("student_id"))
-                if student:
-                    payment_data.append({
-                        "Student Name": student.get("name"),
-                        "Roll Number": student.get("roll_number"),
-                        "Transaction ID": payment.get("transaction_id"),
-                        "Amount": payment.get("amount"),
-                        "Status": payment.get("status"),
-                        "Payment Date": format_datetime(payment.get("payment_datetime", "")),
-                        "Timestamp Type": "Auto" if payment.get("auto_timestamp") else "Manual",
-                        "Screenshot Status": "Deleted" if payment.get("screenshot_deleted") else ("Available" if payment.get("screenshot") else "Not Available"),
-                        "Form Submission Date": format_datetime(payment.get("submission_date", "")),
-                        "Payment Account": payment.get("payment_account", ""),
-                        "Submitted By": "Admin" if payment.get("added_by_admin") else "Student",
-                        "Admin Remarks": payment.get("admin_remarks", ""),
-                        "Student Remarks": payment.get("student_remarks", "")
-                    })
-            
-            if payment_data:
-                df_payments = pd.DataFrame(payment_data)
-                
-                if payment_export_format == "CSV":
-                    csv = df_payments.to_csv(index=False)
-                    st.download_button(
-                        "Download Payment CSV",
-                        csv,
-                        file_name=f"payments_{payment_filter.lower()}_{datetime.now().strftime('%Y%m%d')}.csv",
-                        mime="text/csv",
-                        use_container_width=True
-                    )
-                else:
-                    output = io.BytesIO()
-                    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                        df_payments.to_excel(writer, index=False, sheet_name='Payments')
-                    excel_data = output.getvalue()
-                    
-                    st.download_button(
-                        "Download Payment Excel",
-                        excel_data,
-                        file_name=f"payments_{payment_filter.lower()}_{datetime.now().strftime('%Y%m%d')}.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        use_container_width=True
+            if filtered_payments:
+                if st.button("Prepare Payment Export", use_container_width=True):
+                    start_export(
+                        "payments", payment_export_format, payment_filter, len(filtered_payments),
+                        lambda job: build_payment_export(filtered_payments, students, payment_export_format, job)
                     )
+                
+                extension = "csv" if payment_export_format == "CSV" else "xlsx"
+                show_export_download(
+                    get_export("payments", payment_export_format, payment_filter),
+                    f"Download Payment {payment_export_format}",
+                    f"payments_{payment_filter.lower()}_{datetime.now().strftime('%Y%m%d')}.{extension}",
+                    EXPORT_MIME_TYPES[payment_export_format],
+                    "payment_export_download"
+                )
             else:
                 st.info("No payment data to export")
         
@@ -2458,38 +4720,24 @@ def show_reports():
         screenshot_filter = st.selectbox("Filter by Status", ["All", "Paid", "Unpaid", "Pending"], key="screenshot_filter")
         
         if st.button("Download Screenshots as ZIP", use_container_width=True):
-            # Get filtered payments
-            filtered_payments = payments
-            if screenshot_filter != "All":
-                filtered_payments = [p for p in payments if p.get("status") == screenshot_filter]
-            
-            # Filter payments with active screenshots (not deleted)
-            payments_with_screenshots = [p for p in filtered_payments if p.get("screenshot") and not p.get("screenshot_deleted")]
+            # Payments with active screenshots (not deleted) matching the filter
+            payments_with_screenshots = filter_records("payments", status=screenshot_filter, has_screenshot=True)
             
             if not payments_with_screenshots:
                 st.warning("No active screenshots found for the selected filter")
             else:
-                # Create ZIP file in memory
-                zip_buffer = io.BytesIO()
-                with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                    for payment in payments_with_screenshots:
-                        file_path = UPLOADS_DIR / payment.get("screenshot")
-                        if file_path.exists():
-                            # Get student info for better file naming
-                            student = get_student_by_id(payment.get("student_id"))
-                            if student:
-                                new_name = f"{student.get('roll_number')}_{student.get('name')}_{payment.get('transaction_id')}_{payment.get('screenshot')}"
-                                zip_file.write(file_path, new_name)
-                
-                zip_data = zip_buffer.getvalue()
-                
-                st.download_button(
-                    "Download ZIP",
-                    zip_data,
-                    file_name=f"payment_screenshots_{screenshot_filter.lower()}_{datetime.now().strftime('%Y%m%d')}.zip",
-                    mime="application/zip",
-                    use_container_width=True
+                start_export(
+                    "screenshots", "ZIP", screenshot_filter, len(payments_with_screenshots),
+                    lambda job: build_screenshot_zip(payments_with_screenshots, students, job)
                 )
+        
+        show_export_download(
+            get_export("screenshots", "ZIP", screenshot_filter),
+            "Download ZIP",
+            f"payment_screenshots_{screenshot_filter.lower()}_{datetime.now().strftime('%Y%m%d')}.zip",
+            EXPORT_MIME_TYPES["ZIP"],
+            "screenshot_zip_download"
+        )
     
     with tab3:
         st.subheader("Analytics & Insights")
@@ -2681,4 +4929,8 @@ def show_admin_settings():
             )
 
 if __name__ == "__main__":
-    main()
+    # `streamlit run` passes no arguments; anything else is a maintenance command
+    if len(sys.argv) > 1:
+        run_cli(sys.argv[1:])
+    else:
+        main()